@@ -1,5 +1,5 @@
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 import os
 import json
 import time
@@ -7,56 +7,913 @@ import uuid
 import hmac
 import hashlib
 import base64
+import asyncio
+import functools
+import itertools
+import math
+import queue
+import threading
 import urllib.request
 import sqlite3
-from typing import List, Optional, Dict
+import aiohttp
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from decimal import Decimal, InvalidOperation, ROUND_HALF_EVEN
+from typing import List, Optional, Dict, Callable, Awaitable, Iterator
 from urllib.parse import urlencode
 
-app = FastAPI(title="Receipts Ingestion API (Stripe + Square)")
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name) or default)
+    except ValueError:
+        return default
+
+# Subsystems register async hooks here; they run in order on startup and in reverse on shutdown.
+_startup_hooks: List[Callable[[], Awaitable[None]]] = []
+_shutdown_hooks: List[Callable[[], Awaitable[None]]] = []
+
+@asynccontextmanager
+async def _lifespan(app: FastAPI):
+    for hook in _startup_hooks:
+        await hook()
+    try:
+        yield
+    finally:
+        for hook in reversed(_shutdown_hooks):
+            await hook()
+
+app = FastAPI(title="Receipts Ingestion API (Stripe + Square)", lifespan=_lifespan)
 
 # -------------------------
-# In-memory state (temporary)
+# In-memory transaction cache
 # -------------------------
-transactions: List[dict] = []
-processed_square_event_ids = set()
+# SQLite (receipts + receipt_lines + receipt_payloads) is the source of truth. This keeps
+# the most recently used TX_CACHE_MAX transactions so webhook bursts for the same payment
+# or order mutate one shared dict; lookups that miss fall through to the database.
+TX_CACHE_MAX = _env_int("TX_CACHE_MAX", 10_000)
+
+class TransactionStore:
+    """
+    LRU of transaction dicts with hash indexes on (user_id, merchant, payment_id) and
+    (user_id, merchant, order_id). Callers that change a transaction's payment id or
+    meta.square_order_id must call reindex(tx). Safe to call from worker threads: the
+    cache is guarded by a lock, and SQLite reads happen outside it.
+    """
+
+    def __init__(self, max_size: int):
+        self._lock = threading.RLock()
+        self._max_size = max(1, max_size)
+        self._by_id: "OrderedDict[str, dict]" = OrderedDict()
+        self._by_payment: Dict[tuple, dict] = {}
+        self._by_order: Dict[tuple, dict] = {}
+        self._keys: Dict[str, tuple] = {}  # tx_id -> (payment_key, order_key) currently indexed
+
+    @staticmethod
+    def _index_keys(tx: dict) -> tuple:
+        user_id = str(tx.get("user_id") or "demo_user")
+        merchant = tx.get("merchant")
+        payment_id = tx.get("payment_id")
+        order_id = (tx.get("meta") or {}).get("square_order_id")
+        return (
+            (user_id, merchant, payment_id) if payment_id else None,
+            (user_id, merchant, order_id) if order_id else None,
+        )
+
+    def add(self, tx: dict) -> None:
+        tx_id = tx["id"]
+        with self._lock:
+            self._by_id[tx_id] = tx
+            self._by_id.move_to_end(tx_id)
+            self.reindex(tx)
+            while len(self._by_id) > self._max_size:
+                self._evict(next(iter(self._by_id)))
+
+    def rekey(self, tx: dict, tx_id: str) -> None:
+        """Give tx the id its receipt is stored under, replacing any cached copy of it."""
+        with self._lock:
+            cached = self._by_id.get(tx["id"]) is tx
+            if cached:
+                self._evict(tx["id"])
+            tx["id"] = tx_id
+            if cached:
+                if tx_id in self._by_id:
+                    self._evict(tx_id)
+                self.add(tx)
+
+    def _evict(self, tx_id: str) -> None:
+        tx = self._by_id.pop(tx_id)
+        for key, index in zip(self._keys.pop(tx_id, (None, None)), (self._by_payment, self._by_order)):
+            if key and index.get(key) is tx:
+                del index[key]
+
+    def reindex(self, tx: dict) -> None:
+        tx_id = tx["id"]
+        with self._lock:
+            old_payment_key, old_order_key = self._keys.get(tx_id, (None, None))
+            payment_key, order_key = self._index_keys(tx)
+            if old_payment_key and old_payment_key != payment_key and self._by_payment.get(old_payment_key) is tx:
+                del self._by_payment[old_payment_key]
+            if old_order_key and old_order_key != order_key and self._by_order.get(old_order_key) is tx:
+                del self._by_order[old_order_key]
+            # Latest transaction wins, matching the old newest-first scans.
+            if payment_key:
+                self._by_payment[payment_key] = tx
+            if order_key:
+                self._by_order[order_key] = tx
+            self._keys[tx_id] = (payment_key, order_key)
+
+    def _cached(self, index: dict, key) -> Optional[dict]:
+        with self._lock:
+            tx = index.get(key)
+            if tx is not None:
+                self._by_id.move_to_end(tx["id"])
+            return tx
+
+    def _load(self, user_id: str, where: str, params: tuple) -> Optional[dict]:
+        with _shards.reader(user_id) as conn:
+            found = _db_load_txs(conn, f"r.user_id=? AND {where} ORDER BY r.ts DESC, r.id DESC LIMIT 1", (user_id, *params))
+        if not found:
+            return None
+        with self._lock:
+            # Another handler may have cached it while we were reading.
+            tx = self._by_id.get(found[0]["id"]) or found[0]
+            self.add(tx)
+        return tx
+
+    def by_payment(self, user_id: str, merchant: str, payment_id: str) -> Optional[dict]:
+        user_id = str(user_id)
+        tx = self._cached(self._by_payment, (user_id, merchant, payment_id))
+        if tx is not None:
+            return tx
+        return self._load(user_id, "r.merchant=? AND r.payment_id=?", (merchant, payment_id))
+
+    def by_order(self, user_id: str, merchant: str, order_id: str) -> Optional[dict]:
+        user_id = str(user_id)
+        tx = self._cached(self._by_order, (user_id, merchant, order_id))
+        if tx is not None:
+            return tx
+        return self._load(user_id, "r.merchant=? AND r.order_id=?", (merchant, order_id))
+
+    def get(self, user_id: str, tx_id: str) -> Optional[dict]:
+        user_id = str(user_id)
+        tx = self._cached(self._by_id, tx_id)
+        if tx is not None and str(tx.get("user_id") or "demo_user") == user_id:
+            return tx
+        return self._load(user_id, "r.id=?", (tx_id,))
+
+    def page(
+        self,
+        user_id: str,
+        limit: int,
+        after: Optional[tuple] = None,
+        since: Optional[int] = None,
+        until: Optional[int] = None,
+        newest_first: bool = False,
+        with_meta: bool = True,
+    ) -> List[dict]:
+        """
+        Up to `limit` persisted transactions for user_id ordered by (timestamp, id), starting
+        strictly after the (timestamp, id) key `after`. This is a keyset seek on
+        receipts_user_ts, so a deep page costs the same as the first one. since is
+        inclusive and until exclusive. Cached copies are preferred. with_meta=False skips
+        loading the raw payloads (cached copies still carry theirs).
+        """
+        cmp, order = ("<", "DESC") if newest_first else (">", "ASC")
+        where = ["r.user_id=?"]
+        params: List[object] = [str(user_id)]
+        if after is not None:
+            where.append(f"(r.ts, r.id) {cmp} (?, ?)")
+            params.extend(after)
+        if since is not None:
+            where.append("r.ts>=?")
+            params.append(int(since))
+        if until is not None:
+            where.append("r.ts<?")
+            params.append(int(until))
+        params.append(int(limit))
+        with _shards.reader(user_id) as conn:
+            found = _db_load_txs(
+                conn, " AND ".join(where) + f" ORDER BY r.ts {order}, r.id {order} LIMIT ?", tuple(params), with_meta
+            )
+        with self._lock:
+            return [self._by_id.get(tx["id"]) or tx for tx in found]
+
+    def changes(
+        self, user_id: str, limit: int, since: int = 0, after: Optional[tuple] = None, with_meta: bool = True
+    ) -> tuple:
+        """
+        Receipts changed after change sequence `since` (or after the (seq, id) key `after`),
+        oldest change first, as ([(seq, tx)], version). Both come from one read snapshot,
+        so every change up to `version` is either returned or lies beyond `limit`.
+        """
+        user_id = str(user_id)
+        with _shards.reader(user_id) as conn:
+            conn.execute("BEGIN")
+            row = conn.execute("SELECT version FROM user_versions WHERE user_id=?", (user_id,)).fetchone()
+            if after is not None:
+                bound, params = "(c.seq, c.receipt_id) > (?, ?)", (user_id, *after, int(limit))
+            else:
+                bound, params = "c.seq > ?", (user_id, int(since), int(limit))
+            seqs = dict(conn.execute(
+                f"""
+                SELECT c.receipt_id, c.seq FROM receipt_changes c
+                WHERE c.user_id=? AND {bound}
+                ORDER BY c.seq, c.receipt_id
+                LIMIT ?
+                """,
+                params,
+            ).fetchall())
+            found = _db_load_txs(conn, f"r.id IN ({','.join('?' * len(seqs))})", tuple(seqs), with_meta) if seqs else []
+        with self._lock:
+            changed = [(seqs[tx["id"]], self._by_id.get(tx["id"]) or tx) for tx in found]
+        changed.sort(key=lambda c: (c[0], c[1]["id"]))
+        return changed, row[0] if row else 0
+
+    def for_user(
+        self,
+        user_id: str,
+        newest_first: bool = False,
+        page_size: int = 200,
+        after: Optional[tuple] = None,
+        since: Optional[int] = None,
+        until: Optional[int] = None,
+        with_meta: bool = True,
+    ) -> Iterator[dict]:
+        """
+        Every persisted transaction for user_id (within the same bounds page() takes), by
+        timestamp, read one keyset page at a time so memory stays at one page.
+        """
+        while True:
+            found = self.page(
+                user_id, page_size, after=after, since=since, until=until, newest_first=newest_first, with_meta=with_meta
+            )
+            yield from found
+            if len(found) < page_size:
+                return
+            after = (found[-1]["timestamp"], found[-1]["id"])
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def __iter__(self) -> Iterator[dict]:
+        with self._lock:
+            return iter(list(self._by_id.values()))
+
+transactions = TransactionStore(TX_CACHE_MAX)
 qbo_tokens: Dict[str, dict] = {}
+# -------------------------
+# Money
+# -------------------------
+# Amounts are integers in the currency's minor unit (cents for USD, yen for JPY, fils for
+# KWD), exactly as Stripe and Square send them; quantities are integers in 1/QUANTITY_SCALE
+# (Square allows up to 5 decimal places). Floats only appear at the API edge.
+QUANTITY_SCALE = 100_000
+
+# ISO 4217 exponents that aren't 2.
+_CURRENCY_EXPONENTS: Dict[str, int] = {
+    **dict.fromkeys(("BIF", "CLP", "DJF", "GNF", "ISK", "JPY", "KMF", "KRW", "PYG", "RWF",
+                     "UGX", "UYI", "VND", "VUV", "XAF", "XOF", "XPF"), 0),
+    **dict.fromkeys(("BHD", "IQD", "JOD", "KWD", "LYD", "OMR", "TND"), 3),
+    **dict.fromkeys(("CLF", "UYW"), 4),
+}
+
+def _currency_exponent(currency: Optional[str]) -> int:
+    return _CURRENCY_EXPONENTS.get((currency or "").upper(), 2)
+
+def _to_minor(amount, currency: Optional[str]) -> int:
+    """Major-unit amount (float/str/Decimal) -> integer minor units, without float drift."""
+    try:
+        d = Decimal(str(amount or 0))
+    except InvalidOperation:
+        return 0
+    return int(d.scaleb(_currency_exponent(currency)).to_integral_value(ROUND_HALF_EVEN))
+
+def _minor_to_float(amount_minor: int, currency: Optional[str]) -> float:
+    return (amount_minor or 0) / (10 ** _currency_exponent(currency))
+
+def _format_minor(amount_minor: int, currency: Optional[str]) -> str:
+    return str(Decimal(amount_minor or 0).scaleb(-_currency_exponent(currency)))
+
+def _quantity_to_scaled(quantity) -> int:
+    try:
+        d = Decimal(str(quantity or 0))
+    except InvalidOperation:
+        return 0
+    return int((d * QUANTITY_SCALE).to_integral_value(ROUND_HALF_EVEN))
+
+def _format_quantity(quantity_scaled: int) -> str:
+    return format((Decimal(quantity_scaled or 0) / QUANTITY_SCALE).normalize(), "f")
+
+def _line_amount_minor(quantity_scaled: int, unit_price_minor: int) -> int:
+    """quantity * unit price in minor units, rounded half up once at the end."""
+    whole, rest = divmod(quantity_scaled * unit_price_minor, QUANTITY_SCALE)
+    return whole + (1 if 2 * rest >= QUANTITY_SCALE else 0)
+
+def _item_unit_minor(item: dict, currency: Optional[str]) -> int:
+    unit_minor = item.get("unit_price_minor")
+    return unit_minor if isinstance(unit_minor, int) else _to_minor(item.get("unit_price"), currency)
+
+def _tx_total_minor(tx: dict) -> int:
+    total_minor = tx.get("total_minor")
+    return total_minor if isinstance(total_minor, int) else _to_minor(tx.get("total"), tx.get("currency"))
+
 # -------------------------
 # SQLite (demo spreadsheet)
 # -------------------------
 DB_PATH = os.getenv("DB_PATH") or "receipts.db"
 
-def _db_conn():
-    return sqlite3.connect(DB_PATH, check_same_thread=False)
-
-def _db_init():
-    conn = _db_conn()
+# Connections are long-lived: one writer (SQLite allows a single writer anyway) and a small
+# pool of readers. WAL lets the readers run while the writer commits; synchronous=NORMAL
+# only fsyncs at checkpoints, which is still durable against app crashes in WAL mode.
+DB_READ_POOL_SIZE = _env_int("DB_READ_POOL_SIZE", 4)
+DB_CACHE_SIZE_KB = _env_int("DB_CACHE_SIZE_KB", 64 * 1024)
+DB_MMAP_SIZE = _env_int("DB_MMAP_SIZE", 256 * 1024 * 1024)
+DB_STATEMENT_CACHE_SIZE = _env_int("DB_STATEMENT_CACHE_SIZE", 512)
+DB_BUSY_TIMEOUT_SECONDS = _env_int("DB_BUSY_TIMEOUT_SECONDS", 10)
+
+class _DbPool:
+    def __init__(self, path: str, read_pool_size: int):
+        self.path = path
+        self._read_pool_size = read_pool_size
+        self._writer: Optional[sqlite3.Connection] = None
+        self._write_lock = threading.RLock()
+        self._idle_readers: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._reader_slots = threading.BoundedSemaphore(read_pool_size)
+        self._lock = threading.Lock()
+        self._all: List[sqlite3.Connection] = []
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            check_same_thread=False,
+            timeout=DB_BUSY_TIMEOUT_SECONDS,
+            cached_statements=DB_STATEMENT_CACHE_SIZE,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{int(DB_CACHE_SIZE_KB)}")
+        conn.execute(f"PRAGMA mmap_size={int(DB_MMAP_SIZE)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA foreign_keys=ON")
+        with self._lock:
+            self._all.append(conn)
+        return conn
+
+    @contextmanager
+    def writer(self):
+        """Exclusive use of the writer connection; commits on success, rolls back on error."""
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = self._connect()
+            conn = self._writer
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+
+    @contextmanager
+    def reader(self):
+        """Borrow a reader connection, blocking while all DB_READ_POOL_SIZE are in use."""
+        self._reader_slots.acquire()
+        try:
+            try:
+                conn = self._idle_readers.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+            try:
+                yield conn
+            finally:
+                if conn.in_transaction:
+                    conn.rollback()
+                self._idle_readers.put(conn)
+        finally:
+            self._reader_slots.release()
+
+    def close(self) -> None:
+        with self._write_lock, self._lock:
+            for conn in self._all:
+                conn.close()
+            self._all.clear()
+            self._writer = None
+            self._idle_readers = queue.LifoQueue()
+
+_db = _DbPool(DB_PATH, DB_READ_POOL_SIZE)
+
+# With DB_SHARD_DIR set, each user's receipts (receipts, receipt_lines, receipt_payloads)
+# live in a database file of their own under it, so writes for different tenants no longer
+# queue on one SQLite write lock. DB_PATH keeps the shared tables: webhook queue, dedup,
+# catalog and QBO tokens. At most DB_SHARD_MAX_OPEN shard files stay open; the least
+# recently used idle one is closed to make room. Without DB_SHARD_DIR everything is in DB_PATH.
+DB_SHARD_DIR = os.getenv("DB_SHARD_DIR") or None
+DB_SHARD_MAX_OPEN = _env_int("DB_SHARD_MAX_OPEN", 64)
+DB_SHARD_READ_POOL_SIZE = _env_int("DB_SHARD_READ_POOL_SIZE", 2)
+
+class _Shard:
+    def __init__(self, pool: _DbPool):
+        self.pool = pool
+        self.leases = 0
+        self.ready = False
+        self.init_lock = threading.Lock()
+
+class _ShardRouter:
+    def __init__(self, control: _DbPool, shard_dir: Optional[str], max_open: int, read_pool_size: int):
+        self._control = control
+        self._dir = shard_dir
+        self._max_open = max(1, max_open)
+        self._read_pool_size = read_pool_size
+        self._open: "OrderedDict[str, _Shard]" = OrderedDict()
+        self._lock = threading.Lock()
+        if shard_dir:
+            os.makedirs(shard_dir, exist_ok=True)
+
+    @property
+    def sharded(self) -> bool:
+        return self._dir is not None
+
+    def shard_key(self, user_id) -> str:
+        """File-name-safe key for user_id's shard ("" when unsharded)."""
+        if not self._dir:
+            return ""
+        return hashlib.blake2b(str(user_id).encode("utf-8"), digest_size=10).hexdigest()
+
+    def _acquire(self, key: str) -> _Shard:
+        with self._lock:
+            shard = self._open.get(key)
+            if shard is None:
+                shard = _Shard(_DbPool(os.path.join(self._dir, f"{key}.db"), self._read_pool_size))
+                self._open[key] = shard
+            self._open.move_to_end(key)
+            shard.leases += 1
+            # Close idle shards beyond the cap; leased ones are skipped, so a burst across
+            # many tenants can briefly exceed it.
+            excess = len(self._open) - self._max_open
+            for old_key in list(self._open):
+                if excess <= 0:
+                    break
+                old = self._open[old_key]
+                if old.leases == 0:
+                    del self._open[old_key]
+                    old.pool.close()
+                    excess -= 1
+        # Migrate outside the router lock so opening one new shard doesn't stall the others.
+        with shard.init_lock:
+            if not shard.ready:
+                try:
+                    with shard.pool.writer() as conn:
+                        _db_migrate(conn)
+                except BaseException:
+                    self._release(shard)
+                    raise
+                shard.ready = True
+        return shard
+
+    def _release(self, shard: _Shard) -> None:
+        with self._lock:
+            shard.leases -= 1
+
+    @contextmanager
+    def lease(self, user_id):
+        """The _DbPool holding user_id's receipts; it stays open while leased."""
+        if not self._dir:
+            yield self._control
+            return
+        shard = self._acquire(self.shard_key(user_id))
+        try:
+            yield shard.pool
+        finally:
+            self._release(shard)
+
+    def _exists(self, key: str) -> bool:
+        with self._lock:
+            if key in self._open:
+                return True
+        return os.path.exists(os.path.join(self._dir, f"{key}.db"))
+
+    @contextmanager
+    def reader(self, user_id):
+        # Reads for a user with no shard yet go to DB_PATH instead of creating an empty file
+        # per unknown user_id: its receipts tables have the same schema and stay empty once
+        # sharding is on.
+        if self._dir and not self._exists(self.shard_key(user_id)):
+            with self._control.reader() as conn:
+                yield conn
+            return
+        with self.lease(user_id) as pool, pool.reader() as conn:
+            yield conn
+
+    @contextmanager
+    def writer(self, user_id):
+        with self.lease(user_id) as pool, pool.writer() as conn:
+            yield conn
+
+    def close(self) -> None:
+        with self._lock:
+            for shard in self._open.values():
+                shard.pool.close()
+            self._open.clear()
+
+_shards = _ShardRouter(_db, DB_SHARD_DIR, DB_SHARD_MAX_OPEN, DB_SHARD_READ_POOL_SIZE)
+
+async def _close_db() -> None:
+    _shards.close()
+    _db.close()
+
+_shutdown_hooks.append(_close_db)
+
+def _receipt_key_id(user_id: str, merchant: str, payment_id: str) -> str:
+    """Stable receipt id for rows that predate transaction ids being stored."""
+    return hashlib.blake2b(f"{user_id}\x1f{merchant}\x1f{payment_id}".encode("utf-8"), digest_size=12).hexdigest()
+
+def _migrate_normalize_receipts(conn: sqlite3.Connection) -> None:
     conn.execute("""
-    CREATE TABLE IF NOT EXISTS receipt_items (
+    CREATE TABLE receipts (
       id TEXT PRIMARY KEY,
-      user_id TEXT,
-      merchant TEXT,
-      payment_id TEXT,
+      user_id TEXT NOT NULL,
+      merchant TEXT NOT NULL,
+      payment_id TEXT NOT NULL,
       order_id TEXT,
+      currency TEXT,
+      total REAL,
+      ts INTEGER,
+      line_count INTEGER NOT NULL DEFAULT 0,
+      fingerprint TEXT,
+      UNIQUE (user_id, merchant, payment_id)
+    )
+    """)
+    conn.execute("CREATE INDEX receipts_user_ts ON receipts (user_id, ts, id)")
+    conn.execute("CREATE INDEX receipts_order ON receipts (order_id)")
+    conn.execute("""
+    CREATE TABLE receipt_lines (
+      receipt_id TEXT NOT NULL REFERENCES receipts (id) ON DELETE CASCADE,
+      line_no INTEGER NOT NULL,
       sku TEXT,
       item_name TEXT,
       quantity REAL,
       unit_price REAL,
-      currency TEXT,
-      total REAL,
-      ts INTEGER
-    )
+      PRIMARY KEY (receipt_id, line_no)
+    ) WITHOUT ROWID
     """)
+
+    # Copy receipt_items across inside this migration's transaction. Placeholder
+    # "(no items yet)" rows become headers with line_count 0; line order follows rowid,
+    # i.e. the order the lines were written in.
+    conn.create_function("legacy_receipt_id", 3, _receipt_key_id, deterministic=True)
+    placeholder = "(item_name = '(no items yet)' AND sku IS NULL AND quantity = 0)"
+    conn.execute(f"""
+    INSERT INTO receipts (id, user_id, merchant, payment_id, order_id, currency, total, ts, line_count, fingerprint)
+    SELECT
+      legacy_receipt_id(COALESCE(user_id, ''), COALESCE(merchant, ''), COALESCE(payment_id, '')),
+      COALESCE(user_id, ''), COALESCE(merchant, ''), COALESCE(payment_id, ''),
+      MAX(order_id), MAX(currency), MAX(total), MAX(ts),
+      SUM(CASE WHEN {placeholder} THEN 0 ELSE 1 END),
+      NULL
+    FROM receipt_items
+    GROUP BY COALESCE(user_id, ''), COALESCE(merchant, ''), COALESCE(payment_id, '')
+    """)
+    conn.execute(f"""
+    INSERT INTO receipt_lines (receipt_id, line_no, sku, item_name, quantity, unit_price)
+    SELECT
+      legacy_receipt_id(COALESCE(user_id, ''), COALESCE(merchant, ''), COALESCE(payment_id, '')),
+      ROW_NUMBER() OVER (PARTITION BY COALESCE(user_id, ''), COALESCE(merchant, ''), COALESCE(payment_id, '') ORDER BY rowid) - 1,
+      sku, item_name, quantity, unit_price
+    FROM receipt_items
+    WHERE NOT {placeholder}
+    """)
+    conn.execute("DROP TABLE receipt_items")
+    conn.execute("DROP TABLE IF EXISTS receipt_fingerprints")
+
+def _legacy_to_minor(amount) -> int:
+    # Before integer money, every REAL total/price was the provider's integer minor units
+    # divided by 100 whatever the currency (¥1500 was stored as 15.0, 1.500 KWD as 15.0), so
+    # scaling back by 10**2 through the shortest repr recovers them exactly. The currency's
+    # own exponent must not be applied.
+    try:
+        d = Decimal(str(amount or 0))
+    except InvalidOperation:
+        return 0
+    return int(d.scaleb(2).to_integral_value(ROUND_HALF_EVEN))
+
+def _migrate_money_to_integers(conn: sqlite3.Connection) -> None:
+    conn.create_function("legacy_to_minor", 1, _legacy_to_minor, deterministic=True)
+    conn.create_function("to_quantity_scaled", 1, _quantity_to_scaled, deterministic=True)
+    conn.execute("ALTER TABLE receipts ADD COLUMN total_minor INTEGER NOT NULL DEFAULT 0")
+    conn.execute("UPDATE receipts SET total_minor = legacy_to_minor(total)")
+    conn.execute("ALTER TABLE receipts DROP COLUMN total")
+    conn.execute("ALTER TABLE receipt_lines ADD COLUMN quantity_scaled INTEGER NOT NULL DEFAULT 0")
+    conn.execute("ALTER TABLE receipt_lines ADD COLUMN unit_price_minor INTEGER NOT NULL DEFAULT 0")
     conn.execute("""
-    CREATE TABLE IF NOT EXISTS qbo_tokens (
-      realm_id TEXT PRIMARY KEY,
-      access_token TEXT,
-      refresh_token TEXT,
-      expires_at INTEGER,
-      raw_json TEXT
-    )
+    UPDATE receipt_lines SET
+      quantity_scaled = to_quantity_scaled(quantity),
+      unit_price_minor = legacy_to_minor(unit_price)
+    """)
+    conn.execute("ALTER TABLE receipt_lines DROP COLUMN quantity")
+    conn.execute("ALTER TABLE receipt_lines DROP COLUMN unit_price")
+
+def _utc_day(ts: int) -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime(ts or 0))
+
+def _migrate_daily_rollups(conn: sqlite3.Connection) -> None:
+    conn.execute("""
+    CREATE TABLE rollup_daily_merchant (
+      user_id TEXT NOT NULL,
+      day TEXT NOT NULL,
+      merchant TEXT NOT NULL,
+      currency TEXT NOT NULL,
+      receipts INTEGER NOT NULL,
+      total_minor INTEGER NOT NULL,
+      PRIMARY KEY (user_id, day, merchant, currency)
+    ) WITHOUT ROWID
+    """)
+    conn.execute("""
+    CREATE TABLE rollup_daily_sku (
+      user_id TEXT NOT NULL,
+      day TEXT NOT NULL,
+      sku TEXT NOT NULL,
+      currency TEXT NOT NULL,
+      lines INTEGER NOT NULL,
+      quantity_scaled INTEGER NOT NULL,
+      amount_minor INTEGER NOT NULL,
+      PRIMARY KEY (user_id, day, sku, currency)
+    ) WITHOUT ROWID
+    """)
+    # Backfill from what is already stored, with the same day and rounding rules the write
+    # path uses from here on.
+    conn.create_function("utc_day", 1, _utc_day, deterministic=True)
+    conn.create_function("line_amount_minor", 2, _line_amount_minor, deterministic=True)
+    conn.execute("""
+    INSERT INTO rollup_daily_merchant (user_id, day, merchant, currency, receipts, total_minor)
+    SELECT user_id, utc_day(ts), merchant, COALESCE(currency, ''), COUNT(*), SUM(total_minor)
+    FROM receipts
+    GROUP BY 1, 2, 3, 4
+    """)
+    conn.execute("""
+    INSERT INTO rollup_daily_sku (user_id, day, sku, currency, lines, quantity_scaled, amount_minor)
+    SELECT r.user_id, utc_day(r.ts), COALESCE(l.sku, ''), COALESCE(r.currency, ''),
+      COUNT(*), SUM(l.quantity_scaled), SUM(line_amount_minor(l.quantity_scaled, l.unit_price_minor))
+    FROM receipt_lines l JOIN receipts r ON r.id = l.receipt_id
+    GROUP BY 1, 2, 3, 4
     """)
+
+# Schema changes are applied as named migrations, in order, once per database file.
+# Each runs in its own transaction and is recorded in schema_migrations, so startup is
+# idempotent and concurrent workers don't apply the same step twice. Append new
+# migrations at the end; never edit one that has shipped.
+_DB_MIGRATIONS: List[tuple] = [
+    ("0001_base_tables", [
+        """
+        CREATE TABLE IF NOT EXISTS receipt_items (
+          id TEXT PRIMARY KEY,
+          user_id TEXT,
+          merchant TEXT,
+          payment_id TEXT,
+          order_id TEXT,
+          sku TEXT,
+          item_name TEXT,
+          quantity REAL,
+          unit_price REAL,
+          currency TEXT,
+          total REAL,
+          ts INTEGER
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS webhook_jobs (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          source TEXT NOT NULL,
+          event_id TEXT,
+          payload TEXT NOT NULL,
+          attempts INTEGER NOT NULL DEFAULT 0,
+          visible_at REAL NOT NULL,
+          created_at REAL NOT NULL,
+          last_error TEXT,
+          UNIQUE (source, event_id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS webhook_jobs_visible ON webhook_jobs (source, visible_at)",
+        """
+        CREATE TABLE IF NOT EXISTS webhook_dead_letters (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          source TEXT NOT NULL,
+          event_id TEXT,
+          payload TEXT NOT NULL,
+          attempts INTEGER,
+          last_error TEXT,
+          created_at REAL,
+          failed_at REAL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS processed_events (
+          source TEXT NOT NULL,
+          event_id TEXT NOT NULL,
+          received_at INTEGER NOT NULL,
+          PRIMARY KEY (source, event_id)
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS processed_events_received ON processed_events (received_at)",
+        """
+        CREATE TABLE IF NOT EXISTS catalog_objects (
+          merchant_id TEXT NOT NULL,
+          object_id TEXT NOT NULL,
+          sku TEXT,
+          name TEXT,
+          updated_at TEXT,
+          fetched_at INTEGER NOT NULL,
+          PRIMARY KEY (merchant_id, object_id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS catalog_objects_fetched ON catalog_objects (merchant_id, fetched_at)",
+        """
+        CREATE TABLE IF NOT EXISTS qbo_tokens (
+          realm_id TEXT PRIMARY KEY,
+          access_token TEXT,
+          refresh_token TEXT,
+          expires_at INTEGER,
+          raw_json TEXT
+        )
+        """,
+    ]),
+    ("0002_receipt_items_indexes", [
+        # _db_write_tx: DELETE ... WHERE user_id=? AND merchant=? AND payment_id=?
+        "CREATE INDEX IF NOT EXISTS receipt_items_payment ON receipt_items (user_id, merchant, payment_id)",
+        # demo_receipts: WHERE user_id=? ORDER BY ts DESC LIMIT ?
+        "CREATE INDEX IF NOT EXISTS receipt_items_user_ts ON receipt_items (user_id, ts DESC)",
+        "CREATE INDEX IF NOT EXISTS receipt_items_order ON receipt_items (order_id)",
+    ]),
+    ("0003_receipt_fingerprints", [
+        """
+        CREATE TABLE IF NOT EXISTS receipt_fingerprints (
+          user_id TEXT NOT NULL,
+          merchant TEXT NOT NULL,
+          payment_id TEXT NOT NULL,
+          fingerprint TEXT NOT NULL,
+          PRIMARY KEY (user_id, merchant, payment_id)
+        ) WITHOUT ROWID
+        """,
+    ]),
+    ("0004_normalize_receipts", _migrate_normalize_receipts),
+    ("0005_receipt_payloads", [
+        # Everything in a transaction dict that isn't a header column or a line: the raw
+        # upstream objects under meta, so a receipt can be rebuilt after a restart.
+        """
+        CREATE TABLE receipt_payloads (
+          receipt_id TEXT PRIMARY KEY REFERENCES receipts (id) ON DELETE CASCADE,
+          meta BLOB NOT NULL
+        ) WITHOUT ROWID
+        """,
+        # TransactionStore.by_payment falls back to WHERE merchant=? AND payment_id=?
+        "CREATE INDEX receipts_payment ON receipts (merchant, payment_id)",
+    ]),
+    ("0006_integer_money", _migrate_money_to_integers),
+    ("0007_user_versions", [
+        # Bumped in the same transaction as any receipt change; drives ETags on user reads.
+        """
+        CREATE TABLE user_versions (
+          user_id TEXT PRIMARY KEY,
+          version INTEGER NOT NULL
+        ) WITHOUT ROWID
+        """,
+    ]),
+    ("0008_receipt_changes", [
+        # Change feed: the user version at which each receipt was last written.
+        """
+        CREATE TABLE receipt_changes (
+          receipt_id TEXT PRIMARY KEY REFERENCES receipts (id) ON DELETE CASCADE,
+          user_id TEXT NOT NULL,
+          seq INTEGER NOT NULL
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX receipt_changes_user_seq ON receipt_changes (user_id, seq, receipt_id)",
+        # Existing receipts count as one change at a fresh version, so since=0 returns them all.
+        """
+        INSERT INTO user_versions (user_id, version)
+        SELECT DISTINCT user_id, 1 FROM receipts WHERE true
+        ON CONFLICT(user_id) DO UPDATE SET version=version+1
+        """,
+        """
+        INSERT INTO receipt_changes (receipt_id, user_id, seq)
+        SELECT r.id, r.user_id, v.version FROM receipts r JOIN user_versions v ON v.user_id = r.user_id
+        """,
+    ]),
+    ("0009_daily_rollups", _migrate_daily_rollups),
+    ("0010_receipts_user_order", [
+        # TransactionStore.by_order seeks (user_id, merchant, order_id) and takes the newest;
+        # an order_id-only index lost to walking the user's whole receipts_user_ts range.
+        "DROP INDEX receipts_order",
+        "CREATE INDEX receipts_order ON receipts (user_id, merchant, order_id, ts, id)",
+    ]),
+]
+
+def _db_migrate(conn: sqlite3.Connection) -> List[str]:
+    conn.execute("CREATE TABLE IF NOT EXISTS schema_migrations (name TEXT PRIMARY KEY, applied_at INTEGER NOT NULL)")
     conn.commit()
-    conn.close()
+    done = {row[0] for row in conn.execute("SELECT name FROM schema_migrations")}
+    applied: List[str] = []
+    for name, steps in _DB_MIGRATIONS:
+        if name in done:
+            continue
+        # BEGIN IMMEDIATE takes the write lock up front; re-check inside it in case another
+        # process applied this migration while we were waiting.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("SELECT 1 FROM schema_migrations WHERE name=?", (name,)).fetchone():
+                conn.rollback()
+                continue
+            if callable(steps):
+                steps(conn)
+            else:
+                for sql in steps:
+                    conn.execute(sql)
+            conn.execute("INSERT INTO schema_migrations (name, applied_at) VALUES (?, ?)", (name, int(time.time())))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        applied.append(name)
+    return applied
+
+def _shard_move_legacy_receipts() -> int:
+    """
+    Move receipts left in DB_PATH (from before sharding was enabled) into their users'
+    shards. Each user is copied, committed, then deleted from DB_PATH, so an interrupted
+    move just repeats on the next start.
+    """
+    with _db.reader() as conn:
+        users = [row[0] for row in conn.execute("SELECT DISTINCT user_id FROM receipts")]
+    for user_id in users:
+        with _shards.lease(user_id) as pool, pool.writer() as conn:
+            conn.execute("ATTACH DATABASE ? AS legacy", (_db.path,))
+            try:
+                conn.execute(
+                    """
+                    INSERT OR IGNORE INTO receipts (id, user_id, merchant, payment_id, order_id, currency, total_minor, ts, line_count, fingerprint)
+                    SELECT id, user_id, merchant, payment_id, order_id, currency, total_minor, ts, line_count, fingerprint
+                    FROM legacy.receipts WHERE user_id=?
+                    """,
+                    (user_id,),
+                )
+                conn.execute(
+                    """
+                    INSERT OR IGNORE INTO receipt_lines (receipt_id, line_no, sku, item_name, quantity_scaled, unit_price_minor)
+                    SELECT l.receipt_id, l.line_no, l.sku, l.item_name, l.quantity_scaled, l.unit_price_minor
+                    FROM legacy.receipt_lines l JOIN legacy.receipts r ON r.id = l.receipt_id
+                    WHERE r.user_id=?
+                    """,
+                    (user_id,),
+                )
+                conn.execute(
+                    """
+                    INSERT OR IGNORE INTO receipt_payloads (receipt_id, meta)
+                    SELECT p.receipt_id, p.meta
+                    FROM legacy.receipt_payloads p JOIN legacy.receipts r ON r.id = p.receipt_id
+                    WHERE r.user_id=?
+                    """,
+                    (user_id,),
+                )
+                for table in ("rollup_daily_merchant", "rollup_daily_sku"):
+                    conn.execute(f"INSERT OR IGNORE INTO {table} SELECT * FROM legacy.{table} WHERE user_id=?", (user_id,))
+                conn.execute(
+                    """
+                    INSERT OR IGNORE INTO receipt_changes (receipt_id, user_id, seq)
+                    SELECT receipt_id, user_id, seq FROM legacy.receipt_changes WHERE user_id=?
+                    """,
+                    (user_id,),
+                )
+                # Carry the version over so it keeps increasing past ETags and change
+                # sequence numbers already handed out.
+                conn.execute(
+                    """
+                    INSERT INTO user_versions (user_id, version)
+                    SELECT user_id, version FROM legacy.user_versions WHERE user_id=?
+                    ON CONFLICT(user_id) DO UPDATE SET version=MAX(version, excluded.version)
+                    """,
+                    (user_id,),
+                )
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                conn.execute("DETACH DATABASE legacy")
+        with _db.writer() as conn:
+            # receipt_lines / receipt_payloads go with it (ON DELETE CASCADE).
+            conn.execute("DELETE FROM receipts WHERE user_id=?", (user_id,))
+            for table in ("user_versions", "rollup_daily_merchant", "rollup_daily_sku"):
+                conn.execute(f"DELETE FROM {table} WHERE user_id=?", (user_id,))
+    return len(users)
+
+def _db_init():
+    with _db.writer() as conn:
+        applied = _db_migrate(conn)
+    if applied:
+        print("Applied DB migrations:", ", ".join(applied))
+    if _shards.sharded:
+        moved = _shard_move_legacy_receipts()
+        if moved:
+            print("Moved receipts for", moved, "users into shards under", DB_SHARD_DIR)
 
 _db_init()
 def _db_save_qbo_token(realm_id: str, tok: dict) -> None:
@@ -75,35 +932,30 @@ def _db_save_qbo_token(realm_id: str, tok: dict) -> None:
     if expires_at is not None:
         tok["expires_at"] = expires_at
 
-    conn = _db_conn()
-    conn.execute(
-        """
-        INSERT INTO qbo_tokens (realm_id, access_token, refresh_token, expires_at, raw_json)
-        VALUES (?, ?, ?, ?, ?)
-        ON CONFLICT(realm_id) DO UPDATE SET
-          access_token=excluded.access_token,
-          refresh_token=excluded.refresh_token,
-          expires_at=excluded.expires_at,
-          raw_json=excluded.raw_json
-        """,
-        (
-            str(realm_id),
-            tok.get("access_token"),
-            tok.get("refresh_token"),
-            expires_at,
-            json.dumps(tok),
-        ),
-    )
-    conn.commit()
-    conn.close()
+    with _db.writer() as conn:
+        conn.execute(
+            """
+            INSERT INTO qbo_tokens (realm_id, access_token, refresh_token, expires_at, raw_json)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(realm_id) DO UPDATE SET
+              access_token=excluded.access_token,
+              refresh_token=excluded.refresh_token,
+              expires_at=excluded.expires_at,
+              raw_json=excluded.raw_json
+            """,
+            (
+                str(realm_id),
+                tok.get("access_token"),
+                tok.get("refresh_token"),
+                expires_at,
+                json.dumps(tok),
+            ),
+        )
 
 def _db_load_qbo_tokens() -> None:
     global qbo_tokens
-    conn = _db_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT realm_id, access_token, refresh_token, expires_at, raw_json FROM qbo_tokens")
-    rows = cur.fetchall()
-    conn.close()
+    with _db.reader() as conn:
+        rows = conn.execute("SELECT realm_id, access_token, refresh_token, expires_at, raw_json FROM qbo_tokens").fetchall()
 
     loaded: Dict[str, dict] = {}
     for realm_id, access_token, refresh_token, expires_at, raw_json in rows:
@@ -126,16 +978,15 @@ def _db_load_qbo_tokens() -> None:
     qbo_tokens = loaded
 
 _db_load_qbo_tokens()
-def _db_write_tx(tx: dict):
-    """Upsert receipt line items into SQLite (demo-friendly, spreadsheet-like)."""
-    if not isinstance(tx, dict):
-        return
+_RECEIPT_EVENT_META_KEYS = frozenset(("square_event_id", "square_event_type"))
 
+def _receipt_record(tx: dict):
+    """Build the receipts header row, receipt_lines rows and encoded meta payload for tx."""
     user_id = tx.get("user_id") or "demo_user"
     merchant = tx.get("merchant") or ""
     payment_id = tx.get("payment_id") or ""
     currency = tx.get("currency") or ""
-    total = tx.get("total") or 0
+    total_minor = _tx_total_minor(tx)
     ts = tx.get("timestamp") or int(time.time())
 
     meta = tx.get("meta") or {}
@@ -145,50 +996,550 @@ def _db_write_tx(tx: dict):
     if not isinstance(items, list):
         items = []
 
-    # If there are no items, still store a "header-ish" row so you can see the receipt exists.
-    # (We'll overwrite it later once items arrive.)
-    if not items:
-        items = [{"sku": None, "name": "(no items yet)", "quantity": 0, "unit_price": 0}]
-
-    conn = _db_conn()
-    cur = conn.cursor()
+    lines = []
+    for n, i in enumerate(items):
+        i = i or {}
+        sku = i.get("sku")
+        name = i.get("name") or ""
+        lines.append((n, sku, name, _quantity_to_scaled(i.get("quantity")), _item_unit_minor(i, currency)))
+
+    receipt_id = tx.get("id") or _receipt_key_id(user_id, merchant, payment_id)
+    header = (receipt_id, user_id, merchant, payment_id, order_id, currency, total_minor, int(ts))
+    # Which event last touched a receipt isn't part of it: storing that would make every
+    # redelivery or repeat event rewrite an unchanged receipt and bump the user's version.
+    # (Older transactions may still carry these keys in meta.)
+    payload = {k: v for k, v in meta.items() if k not in _RECEIPT_EVENT_META_KEYS}
+    return header, lines, _json_dumps(payload)
+
+def _receipt_fingerprint(header: tuple, lines: List[tuple], payload: bytes) -> str:
+    # The id is left out: it is fixed by whichever write created the receipt.
+    h = hashlib.blake2b(repr((header[1:], lines)).encode("utf-8"), digest_size=16)
+    h.update(payload)
+    return h.hexdigest()
+
+def _db_apply_receipt(conn: sqlite3.Connection, header: tuple, lines: List[tuple], payload: bytes) -> tuple:
+    """
+    Write one receipt (from _receipt_record) on conn (caller commits), touching only the
+    header/lines/payload that differ. Returns (stored receipt id, whether anything was
+    written); the id is the existing row's when (user, merchant, payment id) was stored.
+    """
+    fingerprint = _receipt_fingerprint(header, lines, payload)
+    _, user_id, merchant, payment_id, order_id, currency, total_minor, ts = header
 
-    # delete old rows for this payment so the table stays clean on updates
-    cur.execute(
-        "DELETE FROM receipt_items WHERE user_id=? AND merchant=? AND payment_id=?",
+    stored = conn.execute(
+        "SELECT id, fingerprint, currency, total_minor, ts FROM receipts WHERE user_id=? AND merchant=? AND payment_id=?",
         (user_id, merchant, payment_id),
-    )
+    ).fetchone()
+    if stored and stored[1] == fingerprint:
+        return stored[0], False
 
-    for i in items:
-        sku = (i or {}).get("sku")
-        name = (i or {}).get("name") or ""
-        qty = (i or {}).get("quantity") or 0
-        unit_price = (i or {}).get("unit_price") or 0
+    if stored:
+        receipt_id = stored[0]
+        conn.execute(
+            """
+            UPDATE receipts
+            SET order_id=?, currency=?, total_minor=?, ts=?, line_count=?, fingerprint=?
+            WHERE id=?
+            """,
+            (order_id, currency, total_minor, ts, len(lines), fingerprint, receipt_id),
+        )
+    else:
+        receipt_id = header[0]
+        conn.execute(
+            """
+            INSERT INTO receipts (id, user_id, merchant, payment_id, order_id, currency, total_minor, ts, line_count, fingerprint)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (*header, len(lines), fingerprint),
+        )
 
-        row_id = str(uuid.uuid4())
-        cur.execute(
+    existing = {
+        row[0]: tuple(row)
+        for row in conn.execute(
+            "SELECT line_no, sku, item_name, quantity_scaled, unit_price_minor FROM receipt_lines WHERE receipt_id=?",
+            (receipt_id,),
+        )
+    }
+    changed = [(receipt_id, *line) for line in lines if existing.get(line[0]) != line]
+    if changed:
+        conn.executemany(
             """
-            INSERT INTO receipt_items
-            (id, user_id, merchant, payment_id, order_id, sku, item_name, quantity, unit_price, currency, total, ts)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            INSERT INTO receipt_lines (receipt_id, line_no, sku, item_name, quantity_scaled, unit_price_minor)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(receipt_id, line_no) DO UPDATE SET
+              sku=excluded.sku,
+              item_name=excluded.item_name,
+              quantity_scaled=excluded.quantity_scaled,
+              unit_price_minor=excluded.unit_price_minor
             """,
-            (row_id, user_id, merchant, payment_id, order_id, sku, name, float(qty), float(unit_price), currency, float(total), int(ts)),
+            changed,
         )
+    if len(existing) > len(lines):
+        conn.execute("DELETE FROM receipt_lines WHERE receipt_id=? AND line_no>=?", (receipt_id, len(lines)))
 
-    conn.commit()
-    conn.close()
+    # Rollups move by (new receipt) - (old receipt), so they stay exact under in-place updates.
+    deltas = _RollupDeltas()
+    if stored:
+        _, _, old_currency, old_total_minor, old_ts = stored
+        deltas.add(-1, old_ts, merchant, old_currency, old_total_minor, existing.values())
+    deltas.add(1, ts, merchant, currency, total_minor, lines)
+    deltas.apply(conn, user_id)
+
+    conn.execute(
+        """
+        INSERT INTO receipt_payloads (receipt_id, meta) VALUES (?, ?)
+        ON CONFLICT(receipt_id) DO UPDATE SET meta=excluded.meta WHERE meta IS NOT excluded.meta
+        """,
+        (receipt_id, payload),
+    )
+    return receipt_id, True
+
+class _RollupDeltas:
+    """Net changes to rollup_daily_merchant / rollup_daily_sku from one receipt write."""
+
+    def __init__(self):
+        self.merchant: Dict[tuple, list] = {}  # (day, merchant, currency) -> [receipts, total_minor]
+        self.sku: Dict[tuple, list] = {}  # (day, sku, currency) -> [lines, quantity_scaled, amount_minor]
+
+    def add(self, sign: int, ts: int, merchant: str, currency: str, total_minor: int, lines) -> None:
+        day = _utc_day(ts)
+        currency = currency or ""
+        m = self.merchant.setdefault((day, merchant, currency), [0, 0])
+        m[0] += sign
+        m[1] += sign * (total_minor or 0)
+        for _, sku, _, qty_scaled, unit_minor in lines:
+            k = self.sku.setdefault((day, sku or "", currency), [0, 0, 0])
+            k[0] += sign
+            k[1] += sign * (qty_scaled or 0)
+            k[2] += sign * _line_amount_minor(qty_scaled or 0, unit_minor or 0)
+
+    def apply(self, conn: sqlite3.Connection, user_id: str) -> None:
+        merchant = [(user_id, *key, *d) for key, d in self.merchant.items() if any(d)]
+        sku = [(user_id, *key, *d) for key, d in self.sku.items() if any(d)]
+        if merchant:
+            conn.executemany(
+                """
+                INSERT INTO rollup_daily_merchant (user_id, day, merchant, currency, receipts, total_minor)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(user_id, day, merchant, currency) DO UPDATE SET
+                  receipts=receipts+excluded.receipts,
+                  total_minor=total_minor+excluded.total_minor
+                """,
+                merchant,
+            )
+        if sku:
+            conn.executemany(
+                """
+                INSERT INTO rollup_daily_sku (user_id, day, sku, currency, lines, quantity_scaled, amount_minor)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(user_id, day, sku, currency) DO UPDATE SET
+                  lines=lines+excluded.lines,
+                  quantity_scaled=quantity_scaled+excluded.quantity_scaled,
+                  amount_minor=amount_minor+excluded.amount_minor
+                """,
+                sku,
+            )
+        # A receipt that moved day/currency or lost lines can empty a bucket; drop it.
+        for row in merchant:
+            if row[4] < 0:
+                conn.execute(
+                    "DELETE FROM rollup_daily_merchant WHERE user_id=? AND day=? AND merchant=? AND currency=? AND receipts=0",
+                    row[:4],
+                )
+        for row in sku:
+            if row[4] < 0:
+                conn.execute(
+                    "DELETE FROM rollup_daily_sku WHERE user_id=? AND day=? AND sku=? AND currency=? AND lines=0",
+                    row[:4],
+                )
+
+# Report period of a rollup day: weeks start on Monday, months on the 1st.
+_ROLLUP_BUCKETS = {
+    "day": "day",
+    "week": "date(day, '-6 days', 'weekday 1')",
+    "month": "substr(day, 1, 7) || '-01'",
+}
+
+def _db_rollup_summary(
+    conn: sqlite3.Connection, user_id: str, start: Optional[str], end: Optional[str], bucket: str
+) -> dict:
+    """
+    Revenue per merchant and lines/units per SKU for each period in [start, end] (UTC days,
+    inclusive), from the rollup tables only, so the cost follows the number of days and
+    keys covered rather than the number of receipts behind them.
+    """
+    period = _ROLLUP_BUCKETS[bucket]
+    where, params = "user_id=?", [user_id]
+    if start:
+        where += " AND day >= ?"
+        params.append(start)
+    if end:
+        where += " AND day <= ?"
+        params.append(end)
+    conn.execute("BEGIN")
+    revenue = [
+        {
+            "period": p,
+            "merchant": merchant,
+            "currency": currency or None,
+            "receipts": receipts,
+            "total_minor": total_minor,
+            "total": _minor_to_float(total_minor, currency),
+        }
+        for p, merchant, currency, receipts, total_minor in conn.execute(
+            f"""
+            SELECT {period} AS p, merchant, currency, SUM(receipts), SUM(total_minor)
+            FROM rollup_daily_merchant WHERE {where}
+            GROUP BY p, merchant, currency ORDER BY p, merchant, currency
+            """,
+            params,
+        )
+    ]
+    skus = [
+        {
+            "period": p,
+            "sku": sku or None,
+            "currency": currency or None,
+            "lines": lines,
+            "quantity": quantity_scaled / QUANTITY_SCALE,
+            "amount_minor": amount_minor,
+            "amount": _minor_to_float(amount_minor, currency),
+        }
+        for p, sku, currency, lines, quantity_scaled, amount_minor in conn.execute(
+            f"""
+            SELECT {period} AS p, sku, currency, SUM(lines), SUM(quantity_scaled), SUM(amount_minor)
+            FROM rollup_daily_sku WHERE {where}
+            GROUP BY p, sku, currency ORDER BY p, sku, currency
+            """,
+            params,
+        )
+    ]
+    return {"revenue": revenue, "skus": skus}
+
+def _db_load_txs(conn: sqlite3.Connection, where: str, params: tuple, with_meta: bool = True) -> List[dict]:
+    """
+    Rebuild transaction dicts from receipts matching `where` (which may carry its own
+    ORDER BY / LIMIT over alias r). Receipts written before payloads were stored get meta {};
+    with_meta=False leaves the payload table out entirely and omits the meta key.
+    """
+    payload_join = "LEFT JOIN receipt_payloads p ON p.receipt_id = r.id" if with_meta else ""
+    rows = conn.execute(
+        f"""
+        SELECT r.id, r.user_id, r.merchant, r.payment_id, r.ts, r.currency, r.total_minor, r.line_count,
+          {"p.meta" if with_meta else "NULL"}
+        FROM receipts r
+        {payload_join}
+        WHERE {where}
+        """,
+        params,
+    ).fetchall()
+    txs: List[dict] = []
+    with_lines: Dict[str, tuple] = {}
+    for receipt_id, user_id, merchant, payment_id, ts, currency, total_minor, line_count, meta in rows:
+        items: List[dict] = []
+        if line_count:
+            with_lines[receipt_id] = (items, currency)
+        tx = {
+            "id": receipt_id,
+            "user_id": user_id,
+            "merchant": merchant,
+            "payment_id": payment_id,
+            "timestamp": ts,
+            "currency": currency,
+            "total": _minor_to_float(total_minor, currency),
+            "total_minor": total_minor,
+            "items": items,
+        }
+        if with_meta:
+            tx["meta"] = _json_loads(meta) if meta else {}
+        txs.append(tx)
+    ids = list(with_lines)
+    # Stay well under SQLite's bound-parameter limit.
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        for receipt_id, sku, name, qty_scaled, unit_minor in conn.execute(
+            f"""
+            SELECT receipt_id, sku, item_name, quantity_scaled, unit_price_minor FROM receipt_lines
+            WHERE receipt_id IN ({",".join("?" * len(chunk))})
+            ORDER BY receipt_id, line_no
+            """,
+            chunk,
+        ):
+            items, currency = with_lines[receipt_id]
+            items.append({
+                "sku": sku,
+                "name": name,
+                "quantity": qty_scaled / QUANTITY_SCALE,
+                "unit_price": _minor_to_float(unit_minor, currency),
+                "unit_price_minor": unit_minor,
+            })
+    return txs
+
+# Every committed receipt change bumps its user's row in user_versions (same transaction),
+# so "nothing changed for this user" can be answered from the version alone. Versions are
+# cached here: this process's writes update the cache as they commit, and writes from other
+# processes show up once the entry is re-read, at most USER_VERSION_TTL_MS later.
+USER_VERSION_TTL_MS = _env_int("USER_VERSION_TTL_MS", 1000)
+USER_VERSION_CACHE_SIZE = _env_int("USER_VERSION_CACHE_SIZE", 100_000)
+
+def _db_record_changes(conn: sqlite3.Connection, user_id: str, receipt_ids: List[str]) -> int:
+    """
+    Bump user_id's version and stamp receipt_ids with it in receipt_changes (caller commits).
+    The version doubles as the change-feed sequence number. Returns it.
+    """
+    version = conn.execute(
+        """
+        INSERT INTO user_versions (user_id, version) VALUES (?, 1)
+        ON CONFLICT(user_id) DO UPDATE SET version=version+1
+        RETURNING version
+        """,
+        (user_id,),
+    ).fetchone()[0]
+    conn.executemany(
+        """
+        INSERT INTO receipt_changes (receipt_id, user_id, seq) VALUES (?, ?, ?)
+        ON CONFLICT(receipt_id) DO UPDATE SET seq=excluded.seq
+        """,
+        [(receipt_id, user_id, version) for receipt_id in receipt_ids],
+    )
+    return version
+
+class _UserVersions:
+    def __init__(self, ttl_ms: int, max_size: int):
+        self._ttl = max(0, ttl_ms) / 1000.0
+        self._max_size = max(1, max_size)
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()  # user_id -> (expires_at, version)
+        self._lock = threading.Lock()
+
+    def get(self, user_id: str) -> int:
+        user_id = str(user_id)
+        with self._lock:
+            entry = self._data.get(user_id)
+            if entry is not None and entry[0] > time.monotonic():
+                return entry[1]
+        with _shards.reader(user_id) as conn:
+            row = conn.execute("SELECT version FROM user_versions WHERE user_id=?", (user_id,)).fetchone()
+        return self.note(user_id, row[0] if row else 0)
+
+    def note(self, user_id: str, version: int) -> int:
+        """Record a version seen in SQLite; never moves backwards (a slow reader may race a commit)."""
+        user_id = str(user_id)
+        with self._lock:
+            entry = self._data.get(user_id)
+            if entry is not None and entry[1] > version:
+                version = entry[1]
+            self._data[user_id] = (time.monotonic() + self._ttl, version)
+            self._data.move_to_end(user_id)
+            while len(self._data) > self._max_size:
+                self._data.popitem(last=False)
+        return version
+
+_user_versions = _UserVersions(USER_VERSION_TTL_MS, USER_VERSION_CACHE_SIZE)
+
+# Receipt writes from every handler funnel into writer threads that commit them in
+# batches: whatever arrived within RECEIPT_WRITER_FLUSH_MS (up to RECEIPT_WRITER_BATCH_SIZE)
+# shares a single transaction per shard, so a burst pays for one commit instead of one per
+# event. Each user always maps to the same thread, which keeps their writes in order; with
+# shards, RECEIPT_WRITER_THREADS lets different tenants commit in parallel.
+RECEIPT_WRITER_BATCH_SIZE = _env_int("RECEIPT_WRITER_BATCH_SIZE", 256)
+RECEIPT_WRITER_FLUSH_MS = _env_int("RECEIPT_WRITER_FLUSH_MS", 5)
+RECEIPT_WRITER_THREADS = _env_int("RECEIPT_WRITER_THREADS", 4 if DB_SHARD_DIR else 1)
+
+class _ReceiptWriter:
+    _STOP = object()
+
+    def __init__(self, shards: _ShardRouter, batch_size: int, flush_ms: int, name: str = "receipt-writer"):
+        self._shards = shards
+        self._name = name
+        self._batch_size = max(1, batch_size)
+        self._flush_seconds = max(0, flush_ms) / 1000.0
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def submit(self, record: tuple) -> Future:
+        fut: Future = Future()
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+                self._thread.start()
+            self._queue.put((record, fut))
+        return fut
+
+    def stop(self) -> None:
+        """Flush everything queued so far, then stop the thread."""
+        with self._lock:
+            thread = self._thread
+            if thread is None:
+                return
+            self._queue.put(self._STOP)
+            self._thread = None
+        thread.join()
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is self._STOP:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self._flush_seconds
+            while len(batch) < self._batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._flush(batch)
+
+    def _flush(self, batch: List[tuple]) -> None:
+        # Once running, a future can no longer be cancelled by a caller that stopped waiting
+        # (e.g. a worker cancelled at shutdown); the write still happens either way.
+        waiting = [fut.set_running_or_notify_cancel() for _, fut in batch]
+        # Unsharded, every user shares DB_PATH, so the batch is one transaction; sharded, one
+        # per shard touched. Versions and change rows are still stamped per user inside it.
+        by_shard: Dict[str, list] = {}
+        for (record, fut), live in zip(batch, waiting):
+            user_id = record[0][1]
+            by_shard.setdefault(self._shards.shard_key(user_id), []).append((user_id, record, fut, live))
+        for items in by_shard.values():
+            self._flush_shard(items)
+
+    def _flush_shard(self, items: List[tuple]) -> None:
+        try:
+            with self._shards.writer(items[0][0]) as conn:
+                results = [_db_apply_receipt(conn, *record) for _, record, _, _ in items]
+                changed: Dict[str, List[str]] = {}
+                for (user_id, _, _, _), (receipt_id, written) in zip(items, results):
+                    if written:
+                        changed.setdefault(user_id, []).append(receipt_id)
+                versions = {user_id: _db_record_changes(conn, user_id, ids) for user_id, ids in changed.items()}
+        except Exception as e:
+            if len(items) == 1:
+                _, _, fut, live = items[0]
+                if live:
+                    fut.set_exception(e)
+                return
+            # Retry one receipt per transaction so a single bad write can't fail the batch.
+            for item in items:
+                self._flush_shard([item])
+            return
+        for user_id, version in versions.items():
+            _user_versions.note(user_id, version)
+        for (_, _, fut, live), (receipt_id, _) in zip(items, results):
+            if live:
+                fut.set_result(receipt_id)
+
+_receipt_writers = [
+    _ReceiptWriter(_shards, RECEIPT_WRITER_BATCH_SIZE, RECEIPT_WRITER_FLUSH_MS, name=f"receipt-writer-{n}")
+    for n in range(max(1, RECEIPT_WRITER_THREADS))
+]
+
+def _receipt_writer_for(user_id: str) -> _ReceiptWriter:
+    key = _shards.shard_key(user_id)
+    return _receipt_writers[int(key[:8], 16) % len(_receipt_writers) if key else 0]
+
+async def _stop_receipt_writer() -> None:
+    for writer in _receipt_writers:
+        await asyncio.to_thread(writer.stop)
+
+_shutdown_hooks.append(_stop_receipt_writer)
+
+def _db_write_tx(tx: dict) -> Future:
+    """
+    Queue tx's receipt header, lines and payload for the next group commit.
+    The rows are snapshotted now; the future resolves to the stored receipt id once they
+    are committed.
+    """
+    if not isinstance(tx, dict):
+        fut: Future = Future()
+        fut.set_result(None)
+        return fut
+    record = _receipt_record(tx)
+    return _receipt_writer_for(record[0][1]).submit(record)
+
+async def _db_write_tx_async(tx: dict) -> Optional[str]:
+    """
+    Persist tx and wait until its batch has been committed. If the receipt was already
+    stored under another id, tx (and its cache entry) take that id, so the cache never
+    serves an id SQLite doesn't have.
+    """
+    receipt_id = await asyncio.wrap_future(_db_write_tx(tx))
+    if receipt_id and tx.get("id") and tx["id"] != receipt_id:
+        transactions.rekey(tx, receipt_id)
+    return receipt_id
 
 square_oauth_tokens: Dict[str, dict] = {}
 
+# -------------------------
+# JSON codec
+# -------------------------
+# orjson parses/serializes large Square payloads several times faster than the stdlib;
+# it is optional and everything falls back to json when it isn't installed.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    def _json_loads(data):
+        return orjson.loads(data)
+
+    def _json_dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+else:
+    def _json_loads(data):
+        return json.loads(data)
+
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+def _json_response(obj, **kwargs) -> Response:
+    """Encode with the codec above instead of FastAPI's jsonable_encoder walk."""
+    return Response(content=_json_dumps(obj), media_type="application/json", **kwargs)
+
 # -------------------------
 # Helpers
 # -------------------------
 def _money_to_float(money: dict) -> float:
     try:
-        return (money.get("amount") or 0) / 100.0
+        return _minor_to_float(money.get("amount") or 0, money.get("currency"))
     except Exception:
         return 0.0
 
+def _money_to_minor(money: dict) -> int:
+    amount = (money or {}).get("amount")
+    return amount if isinstance(amount, int) else 0
+
+async def _user_etag(request: Request, user_id: str) -> str:
+    """
+    Strong ETag for a per-user read: the user's data version plus a hash of everything else
+    that shapes the response (path, query, Accept). Computed before reading any data, so
+    the body sent under it is never older than the version it names.
+    """
+    query = urlencode(sorted(request.query_params.multi_items()))
+    shape = f"{request.url.path}?{query}\x1f{request.headers.get('accept') or ''}"
+    digest = hashlib.blake2b(shape.encode("utf-8"), digest_size=8).hexdigest()
+    # A cache miss reads SQLite; off the loop, since readers can all be busy.
+    version = await asyncio.to_thread(_user_versions.get, user_id)
+    return f'"{version}-{digest}"'
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # If-None-Match uses weak comparison, so W/"x" matches "x".
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+def _not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+
 def _request_public_url(request: Request) -> str:
     # Try to construct a public URL for webhook signature verification.
     # Prefer explicit env var SQUARE_WEBHOOK_NOTIFICATION_URL when set.
@@ -197,6 +1548,64 @@ def _request_public_url(request: Request) -> str:
     path = request.url.path
     return f"{scheme}://{host}{path}"
 
+# -------------------------
+# Outbound call executors
+# -------------------------
+# The QBO/Stripe clients are blocking, so their outbound calls run on a per-provider
+# thread pool (Square uses the native async client below). A slow upstream only
+# exhausts its own pool; once its queue limit is hit we fail fast with 503 so the
+# provider retries later instead of piling up more work.
+class UpstreamBusy(RuntimeError):
+    pass
+
+class _BoundedExecutor:
+    def __init__(self, name: str, max_workers: int, queue_limit: int):
+        self.name = name
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"{name}-io")
+        # One slot per running call plus one per queued call.
+        self._slots = threading.BoundedSemaphore(max_workers + queue_limit)
+
+    async def run(self, fn: Callable, *args, **kwargs):
+        if not self._slots.acquire(blocking=False):
+            raise UpstreamBusy(f"{self.name} executor queue is full")
+        try:
+            fut = self._pool.submit(functools.partial(fn, *args, **kwargs))
+        except BaseException:
+            self._slots.release()
+            raise
+        # Release when the thread finishes, not when the awaiting request goes away.
+        fut.add_done_callback(lambda _: self._slots.release())
+        return await asyncio.wrap_future(fut)
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+_executors: Dict[str, _BoundedExecutor] = {
+    provider: _BoundedExecutor(
+        provider,
+        max_workers=_env_int(f"{provider.upper()}_POOL_SIZE", pool_size),
+        queue_limit=_env_int(f"{provider.upper()}_POOL_QUEUE_LIMIT", queue_limit),
+    )
+    for provider, pool_size, queue_limit in (
+        ("qbo", 4, 32),
+        ("stripe", 8, 32),
+    )
+}
+
+async def _offload(provider: str, fn: Callable, *args, **kwargs):
+    """Run a blocking upstream call on the provider's pool without stalling the event loop."""
+    return await _executors[provider].run(fn, *args, **kwargs)
+
+async def _shutdown_executors() -> None:
+    for ex in _executors.values():
+        ex.shutdown()
+
+_shutdown_hooks.append(_shutdown_executors)
+
+@app.exception_handler(UpstreamBusy)
+async def _upstream_busy_handler(request: Request, exc: UpstreamBusy):
+    return JSONResponse({"ok": False, "detail": str(exc)}, status_code=503, headers={"Retry-After": "5"})
+
 # -------------------------
 # Stripe
 # -------------------------
@@ -221,95 +1630,375 @@ if not SQUARE_ACCESS_TOKEN:
 
 SQUARE_API_BASE = "https://connect.squareup.com"
 
+# One keep-alive pool shared by every Square call (orders, catalog, backfill, OAuth),
+# so only the first request to the host pays for the TCP + TLS handshake.
+SQUARE_HTTP_POOL_SIZE = _env_int("SQUARE_HTTP_POOL_SIZE", 100)
+SQUARE_HTTP_PER_HOST_LIMIT = _env_int("SQUARE_HTTP_PER_HOST_LIMIT", 32)
+SQUARE_HTTP_KEEPALIVE_SECONDS = _env_int("SQUARE_HTTP_KEEPALIVE_SECONDS", 30)
+SQUARE_HTTP_CONNECT_TIMEOUT = _env_int("SQUARE_HTTP_CONNECT_TIMEOUT", 5)
+SQUARE_HTTP_TIMEOUT = _env_int("SQUARE_HTTP_TIMEOUT", 20)
+
+_square_http: Optional[aiohttp.ClientSession] = None
+
+def _square_session() -> aiohttp.ClientSession:
+    global _square_http
+    if _square_http is None or _square_http.closed:
+        connector = aiohttp.TCPConnector(
+            limit=SQUARE_HTTP_POOL_SIZE,
+            limit_per_host=SQUARE_HTTP_PER_HOST_LIMIT,
+            keepalive_timeout=SQUARE_HTTP_KEEPALIVE_SECONDS,
+        )
+        timeout = aiohttp.ClientTimeout(total=SQUARE_HTTP_TIMEOUT, connect=SQUARE_HTTP_CONNECT_TIMEOUT)
+        _square_http = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return _square_http
+
+async def _close_square_session() -> None:
+    global _square_http
+    if _square_http is not None and not _square_http.closed:
+        await _square_http.close()
+    _square_http = None
+
+_shutdown_hooks.append(_close_square_session)
+
 def _square_expected_signature(signature_key: str, notification_url: str, body_bytes: bytes) -> str:
     message = (notification_url or "").encode("utf-8") + (body_bytes or b"")
     digest = hmac.new(signature_key.encode("utf-8"), message, hashlib.sha256).digest()
     return base64.b64encode(digest).decode("utf-8")
     
-def _square_request(path: str, method: str = "GET", body: Optional[dict] = None) -> dict:
-    if not SQUARE_ACCESS_TOKEN:
+def _square_token_for(merchant_id: Optional[str]) -> Optional[str]:
+    """The merchant's OAuth token when we have one, else the env/default token."""
+    return (square_oauth_tokens.get(merchant_id or "") or {}).get("access_token") or SQUARE_ACCESS_TOKEN
+
+async def _square_request(path: str, method: str = "GET", body: Optional[dict] = None, access_token: Optional[str] = None) -> dict:
+    access_token = access_token or SQUARE_ACCESS_TOKEN
+    if not access_token:
         raise RuntimeError("Square access token missing")
 
     url = f"{SQUARE_API_BASE}{path}"
     data = None
-    headers = {"Authorization": f"Bearer {SQUARE_ACCESS_TOKEN}", "Content-Type": "application/json", "Accept": "application/json"}
+    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json", "Accept": "application/json"}
     if body is not None:
-        data = json.dumps(body).encode("utf-8")
+        data = _json_dumps(body)
 
-    req = urllib.request.Request(url, data=data, headers=headers, method=method)
     try:
-        with urllib.request.urlopen(req, timeout=20) as resp:
-            raw = resp.read().decode("utf-8") or "{}"
-            return json.loads(raw)
-    except urllib.error.HTTPError as e:
-        try:
-            err = e.read().decode("utf-8")
-        except Exception:
-            err = str(e)
-        print("Square API error:", e.code, err)
-        return {"error": True, "status": e.code, "detail": err}
+        async with _square_session().request(method, url, data=data, headers=headers) as resp:
+            raw = await resp.read()
+            if resp.status >= 400:
+                err = raw.decode("utf-8", errors="replace")
+                print("Square API error:", resp.status, err)
+                return {"error": True, "status": resp.status, "detail": err}
+            return _json_loads(raw or b"{}")
     except Exception as e:
         print("Square API request failed:", str(e))
         return {"error": True, "detail": str(e)}
 
-def _square_get_order(order_id: str) -> Optional[dict]:
+async def _square_get_order(order_id: str, access_token: Optional[str] = None) -> Optional[dict]:
     if not order_id:
         return None
-    resp = _square_request(f"/v2/orders/{order_id}", method="GET")
+    resp = await _square_request(f"/v2/orders/{order_id}", method="GET", access_token=access_token)
     if isinstance(resp, dict) and resp.get("order"):
         return resp.get("order")
     return None
 
-def _square_get_catalog_object(object_id: str) -> Optional[dict]:
-    if not object_id:
-        return None
-    resp = _square_request(f"/v2/catalog/object/{object_id}", method="GET")
-    if isinstance(resp, dict) and resp.get("object"):
-        return resp.get("object")
-    return None
+SQUARE_CATALOG_BATCH_SIZE = _env_int("SQUARE_CATALOG_BATCH_SIZE", 100)
 
-def _order_to_items(order: dict) -> List[dict]:
+async def _square_batch_get_catalog_objects(object_ids: List[str], access_token: Optional[str] = None):
     """
-    Convert Square Order object to our items format:
-      { sku, name, quantity, unit_price }
+    Resolve many catalog ids with batch-retrieve, one request per chunk (chunks run concurrently).
+    Returns (found objects by id, ids whose chunk request failed).
     """
-    items: List[dict] = []
+    ids = [i for i in dict.fromkeys(object_ids) if i]
+    if not ids:
+        return {}, set()
+
+    chunks = [ids[n:n + SQUARE_CATALOG_BATCH_SIZE] for n in range(0, len(ids), SQUARE_CATALOG_BATCH_SIZE)]
+    responses = await asyncio.gather(*(
+        _square_request("/v2/catalog/batch-retrieve", method="POST", body={"object_ids": chunk}, access_token=access_token)
+        for chunk in chunks
+    ))
+
+    found: Dict[str, dict] = {}
+    failed = set()
+    for chunk, resp in zip(chunks, responses):
+        if not isinstance(resp, dict) or resp.get("error"):
+            failed.update(chunk)
+            continue
+        for obj in resp.get("objects") or []:
+            if isinstance(obj, dict) and obj.get("id"):
+                found[obj["id"]] = obj
+    return found, failed
+
+# -------------------------
+# Square catalog cache
+# -------------------------
+class _TTLCache:
+    """Size-bounded LRU where every entry also expires after its own TTL."""
+
+    MISS = object()
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._data: "OrderedDict[tuple, tuple]" = OrderedDict()  # key -> (expires_at, value)
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return self.MISS
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            return self.MISS
+        self._data.move_to_end(key)
+        self.hits += 1
+        if value is None:
+            self.negative_hits += 1
+        return value
+
+    def put(self, key, value, ttl: float) -> None:
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_ratio": (self.hits / lookups) if lookups else None,
+        }
+
+CATALOG_CACHE_SIZE = _env_int("CATALOG_CACHE_SIZE", 50000)
+CATALOG_CACHE_TTL_SECONDS = _env_int("CATALOG_CACHE_TTL_SECONDS", 6 * 3600)
+# Unknown ids (not returned by Square) and ids whose lookup errored are cached as None
+# so a bad id costs one upstream call per TTL instead of one per event.
+CATALOG_CACHE_NEGATIVE_TTL_SECONDS = _env_int("CATALOG_CACHE_NEGATIVE_TTL_SECONDS", 600)
+CATALOG_CACHE_ERROR_TTL_SECONDS = _env_int("CATALOG_CACHE_ERROR_TTL_SECONDS", 30)
+
+_catalog_cache = _TTLCache(CATALOG_CACHE_SIZE)
+
+def _catalog_variation_summary(obj: dict) -> dict:
+    item_data = (obj.get("item_variation_data") or {})
+    return {"sku": item_data.get("sku"), "name": item_data.get("name")}
+
+async def _square_resolve_catalog(
+    merchant_id: Optional[str], object_ids: List[str], access_token: Optional[str] = None
+) -> Dict[str, dict]:
+    """Look up variation summaries ({sku, name}) by catalog id, going upstream only for cache misses."""
+    merchant_key = merchant_id or ""
+    resolved: Dict[str, dict] = {}
+    misses: List[str] = []
+    for object_id in dict.fromkeys(object_ids):
+        cached = _catalog_cache.get((merchant_key, object_id))
+        if cached is _TTLCache.MISS:
+            misses.append(object_id)
+        elif cached is not None:
+            resolved[object_id] = cached
+
+    if misses:
+        # Next tier: what earlier enrichments already persisted.
+        stored = await asyncio.to_thread(_catalog_db_load, merchant_key, misses)
+        for object_id, summary in stored.items():
+            _catalog_cache.put((merchant_key, object_id), summary, CATALOG_CACHE_TTL_SECONDS)
+            resolved[object_id] = summary
+        misses = [i for i in misses if i not in stored]
+
+    if misses:
+        found, failed = await _square_batch_get_catalog_objects(misses, access_token or _square_token_for(merchant_id))
+        await asyncio.to_thread(_catalog_db_save, merchant_key, list(found.values()))
+        for object_id in misses:
+            obj = found.get(object_id)
+            if obj is not None:
+                summary = _catalog_variation_summary(obj)
+                _catalog_cache.put((merchant_key, object_id), summary, CATALOG_CACHE_TTL_SECONDS)
+                resolved[object_id] = summary
+            elif object_id in failed:
+                _catalog_cache.put((merchant_key, object_id), None, CATALOG_CACHE_ERROR_TTL_SECONDS)
+            else:
+                _catalog_cache.put((merchant_key, object_id), None, CATALOG_CACHE_NEGATIVE_TTL_SECONDS)
+
+    return resolved
+
+@app.get("/api/square/catalog-cache")
+async def square_catalog_cache_stats():
+    return {"ok": True, "cache": _catalog_cache.stats()}
+
+# -------------------------
+# Square catalog store (SQLite)
+# -------------------------
+# catalog_objects keeps every variation -> sku/name mapping we have resolved, so a restart
+# starts from a warm cache instead of re-fetching the catalog. fetched_at records when we
+# last confirmed a row; the refresher re-validates rows older than CATALOG_STALE_SECONDS
+# with one catalog search per merchant instead of per-object GETs.
+CATALOG_WARM_ON_STARTUP = _env_int("CATALOG_WARM_ON_STARTUP", 1)
+CATALOG_REFRESH_INTERVAL_SECONDS = _env_int("CATALOG_REFRESH_INTERVAL_SECONDS", 3600)
+CATALOG_STALE_SECONDS = _env_int("CATALOG_STALE_SECONDS", 24 * 3600)
+
+def _catalog_db_load(merchant_id: str, object_ids: List[str]) -> Dict[str, dict]:
+    if not object_ids:
+        return {}
+    with _db.reader() as conn:
+        placeholders = ",".join("?" for _ in object_ids)
+        rows = conn.execute(
+            f"SELECT object_id, sku, name FROM catalog_objects WHERE merchant_id=? AND object_id IN ({placeholders})",
+            (merchant_id, *object_ids),
+        ).fetchall()
+    return {object_id: {"sku": sku, "name": name} for object_id, sku, name in rows}
+
+def _catalog_db_save(merchant_id: str, objects: List[dict]) -> None:
+    if not objects:
+        return
+    now = int(time.time())
+    rows = []
+    for obj in objects:
+        summary = _catalog_variation_summary(obj)
+        rows.append((merchant_id, obj["id"], summary["sku"], summary["name"], obj.get("updated_at"), now))
+    with _db.writer() as conn:
+        conn.executemany(
+            """
+            INSERT INTO catalog_objects (merchant_id, object_id, sku, name, updated_at, fetched_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(merchant_id, object_id) DO UPDATE SET
+              sku=excluded.sku,
+              name=excluded.name,
+              updated_at=excluded.updated_at,
+              fetched_at=excluded.fetched_at
+            """,
+            rows,
+        )
+
+def _catalog_warm_cache() -> int:
+    with _db.reader() as conn:
+        rows = conn.execute(
+            "SELECT merchant_id, object_id, sku, name FROM catalog_objects ORDER BY fetched_at DESC LIMIT ?",
+            (CATALOG_CACHE_SIZE,),
+        ).fetchall()
+    # Oldest first so the most recently confirmed rows end up at the hot end of the LRU.
+    for merchant_id, object_id, sku, name in reversed(rows):
+        _catalog_cache.put((merchant_id, object_id), {"sku": sku, "name": name}, CATALOG_CACHE_TTL_SECONDS)
+    return len(rows)
+
+def _rfc3339(ts: float) -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(ts))
+
+def _catalog_db_stale_ids(merchant_id: str, cutoff: int) -> set:
+    with _db.reader() as conn:
+        return {
+            row[0]
+            for row in conn.execute(
+                "SELECT object_id FROM catalog_objects WHERE merchant_id=? AND fetched_at<?",
+                (merchant_id, cutoff),
+            )
+        }
+
+async def _catalog_refresh_merchant(merchant_id: str, stale_since: int, access_token: str) -> None:
+    refreshed_at = int(time.time())
+    known = await asyncio.to_thread(_catalog_db_stale_ids, merchant_id, refreshed_at - CATALOG_STALE_SECONDS)
+    if not known:
+        return
+
+    changed: List[dict] = []
+    deleted: List[str] = []
+    body = {
+        "object_types": ["ITEM_VARIATION"],
+        "begin_time": _rfc3339(stale_since),
+        "include_deleted_objects": True,
+    }
+    while True:
+        resp = await _square_request("/v2/catalog/search", method="POST", body=body, access_token=access_token)
+        if not isinstance(resp, dict) or resp.get("error"):
+            # Leave fetched_at alone so the rows stay stale and we try again next round.
+            return
+        for obj in resp.get("objects") or []:
+            if not isinstance(obj, dict) or obj.get("id") not in known:
+                continue
+            (deleted if obj.get("is_deleted") else changed).append(obj)
+        cursor = resp.get("cursor")
+        if not cursor:
+            break
+        body = dict(body, cursor=cursor)
+
+    await asyncio.to_thread(_catalog_db_refreshed, merchant_id, changed, deleted, refreshed_at)
+    for obj in changed:
+        _catalog_cache.put((merchant_id, obj["id"]), _catalog_variation_summary(obj), CATALOG_CACHE_TTL_SECONDS)
+    for obj in deleted:
+        _catalog_cache.put((merchant_id, obj["id"]), None, CATALOG_CACHE_NEGATIVE_TTL_SECONDS)
+
+def _catalog_db_refreshed(merchant_id: str, changed: List[dict], deleted: List[dict], refreshed_at: int) -> None:
+    _catalog_db_save(merchant_id, changed)
+    with _db.writer() as conn:
+        if deleted:
+            conn.executemany(
+                "DELETE FROM catalog_objects WHERE merchant_id=? AND object_id=?",
+                [(merchant_id, obj["id"]) for obj in deleted],
+            )
+        # Anything Square did not report has not changed since stale_since, so it is valid as of now.
+        conn.execute(
+            "UPDATE catalog_objects SET fetched_at=? WHERE merchant_id=? AND fetched_at<?",
+            (refreshed_at, merchant_id, refreshed_at - CATALOG_STALE_SECONDS),
+        )
+
+def _catalog_db_stale_merchants(cutoff: int) -> List[tuple]:
+    with _db.reader() as conn:
+        return conn.execute(
+            "SELECT merchant_id, MIN(fetched_at) FROM catalog_objects WHERE fetched_at<? GROUP BY merchant_id",
+            (cutoff,),
+        ).fetchall()
+
+async def _catalog_refresh_stale() -> None:
+    merchants = await asyncio.to_thread(_catalog_db_stale_merchants, int(time.time()) - CATALOG_STALE_SECONDS)
+    for merchant_id, stale_since in merchants:
+        access_token = _square_token_for(merchant_id)
+        if not access_token:
+            continue
+        await _catalog_refresh_merchant(merchant_id, stale_since, access_token)
+
+async def _catalog_refresher() -> None:
+    while True:
+        await asyncio.sleep(CATALOG_REFRESH_INTERVAL_SECONDS)
+        try:
+            await _catalog_refresh_stale()
+        except Exception as e:
+            print("Catalog refresh failed:", repr(e))
+
+_catalog_refresher_task: Optional[asyncio.Task] = None
+
+async def _start_catalog_refresher() -> None:
+    global _catalog_refresher_task
+    if CATALOG_WARM_ON_STARTUP:
+        print("Catalog cache warmed with", _catalog_warm_cache(), "objects")
+    _catalog_refresher_task = asyncio.create_task(_catalog_refresher())
+
+async def _stop_catalog_refresher() -> None:
+    if _catalog_refresher_task is not None:
+        _catalog_refresher_task.cancel()
+        await asyncio.gather(_catalog_refresher_task, return_exceptions=True)
 
+_startup_hooks.append(_start_catalog_refresher)
+_shutdown_hooks.append(_stop_catalog_refresher)
+
+def _order_line_items(order: dict) -> List[dict]:
     # Primary: order.line_items
     line_items = order.get("line_items") or []
     if isinstance(line_items, list) and line_items:
-        for li in line_items:
-            if not isinstance(li, dict):
-                continue
-            name = li.get("name") or ""
-            quantity = li.get("quantity") or "1"
-            try:
-                quantity_f = float(quantity)
-            except Exception:
-                quantity_f = 1.0
-            base_price_money = (li.get("base_price_money") or {})
-            unit_price = _money_to_float(base_price_money)
-
-            # SKU resolution (best-effort)
-            sku = li.get("sku") or None
-            catalog_object_id = li.get("catalog_object_id") or li.get("variation_id")
-            if not sku and catalog_object_id:
-                obj = _square_get_catalog_object(catalog_object_id)
-                if isinstance(obj, dict):
-                    item_data = (obj.get("item_variation_data") or {})
-                    sku = item_data.get("sku") or sku
-
-            items.append(
-                {
-                    "sku": sku,
-                    "name": name,
-                    "quantity": quantity_f if quantity_f.is_integer() else quantity_f,
-                    "unit_price": unit_price,
-                }
-            )
-        return items
+        return [li for li in line_items if isinstance(li, dict)]
 
     # Fallback: Square Websites can sometimes place items under fulfillments shipment_details
+    lines: List[dict] = []
     fulfillments = order.get("fulfillments") or []
     if isinstance(fulfillments, list):
         for f in fulfillments:
@@ -319,42 +2008,107 @@ def _order_to_items(order: dict) -> List[dict]:
             ship_items = ship.get("line_items") or []
             if not isinstance(ship_items, list):
                 continue
-            for li in ship_items:
-                if not isinstance(li, dict):
-                    continue
-                name = li.get("name") or ""
-                quantity = li.get("quantity") or "1"
-                try:
-                    quantity_f = float(quantity)
-                except Exception:
-                    quantity_f = 1.0
-                base_price_money = (li.get("base_price_money") or {})
-                unit_price = _money_to_float(base_price_money)
-                sku = li.get("sku") or None
-
-                catalog_object_id = li.get("catalog_object_id") or li.get("variation_id")
-                if not sku and catalog_object_id:
-                    obj = _square_get_catalog_object(catalog_object_id)
-                    if isinstance(obj, dict):
-                        item_data = (obj.get("item_variation_data") or {})
-                        sku = item_data.get("sku") or sku
-
-                items.append(
-                    {
-                        "sku": sku,
-                        "name": name,
-                        "quantity": quantity_f if quantity_f.is_integer() else quantity_f,
-                        "unit_price": unit_price,
-                    }
-                )
+            lines.extend(li for li in ship_items if isinstance(li, dict))
+    return lines
+
+def _line_catalog_id(li: dict) -> Optional[str]:
+    return li.get("catalog_object_id") or li.get("variation_id")
+
+async def _order_to_items(order: dict, merchant_id: Optional[str] = None, access_token: Optional[str] = None) -> List[dict]:
+    """
+    Convert Square Order object to our items format:
+      { sku, name, quantity, unit_price, unit_price_minor }
+    """
+    lines = _order_line_items(order)
+
+    # SKU resolution (best-effort): one batched lookup for every line missing a sku
+    missing = [_line_catalog_id(li) for li in lines if not li.get("sku") and _line_catalog_id(li)]
+    catalog = await _square_resolve_catalog(merchant_id, missing, access_token) if missing else {}
+
+    items: List[dict] = []
+    for li in lines:
+        name = li.get("name") or ""
+        quantity = li.get("quantity") or "1"
+        try:
+            quantity_f = float(quantity)
+        except Exception:
+            quantity_f = 1.0
+        base_price_money = (li.get("base_price_money") or {})
+        unit_price = _money_to_float(base_price_money)
+        unit_price_minor = _money_to_minor(base_price_money)
+
+        sku = li.get("sku") or None
+        if not sku:
+            variation = catalog.get(_line_catalog_id(li) or "")
+            if variation:
+                sku = variation.get("sku") or sku
+
+        items.append(
+            {
+                "sku": sku,
+                "name": name,
+                "quantity": quantity_f,
+                "unit_price": unit_price,
+                "unit_price_minor": unit_price_minor,
+            }
+        )
 
     return items
 
-def _find_square_tx_by_payment_id(payment_id: str) -> Optional[dict]:
-    for t in reversed(transactions):
-        if t.get("merchant") == "square" and t.get("payment_id") == payment_id:
-            return t
-    return None
+# Square sends payment.created/payment.updated/order.updated for the same order within
+# milliseconds. Concurrent fetches of one order share a single in-flight request, and the
+# parsed result is kept briefly per (order id, version) so a repeat event for the same
+# order version is free. payment.* events carry no order version, so they never reuse a
+# cached result: payment.updated is usually the one that brings the completed order.
+SQUARE_ORDER_CACHE_SIZE = _env_int("SQUARE_ORDER_CACHE_SIZE", 2000)
+SQUARE_ORDER_CACHE_TTL_SECONDS = _env_int("SQUARE_ORDER_CACHE_TTL_SECONDS", 10)
+
+_order_inflight: Dict[str, asyncio.Future] = {}
+_order_results = _TTLCache(SQUARE_ORDER_CACHE_SIZE)  # (order_id, version) -> (order, items)
+
+async def _square_load_order_items(order_id: str, merchant_id: Optional[str], access_token: Optional[str]):
+    order_full = await _square_get_order(order_id, access_token)
+    if isinstance(order_full, dict):
+        items = await _order_to_items(order_full, merchant_id, access_token)
+        if order_full.get("version") is not None:
+            _order_results.put((order_id, order_full["version"]), (order_full, items), SQUARE_ORDER_CACHE_TTL_SECONDS)
+        return order_full, items
+    return order_full, []
+
+async def _square_fetch_order_items(
+    order_id: str, merchant_id: Optional[str] = None, version: Optional[int] = None, access_token: Optional[str] = None
+):
+    """
+    Fetch an order and resolve its items in one go, with merchant_id's token unless
+    access_token is given.
+    When the event carries the order version, a cached result at exactly that version is
+    reused; without one, only a fetch already in flight is shared.
+    """
+    if version is not None:
+        cached = _order_results.get((order_id, version))
+        if cached is not _TTLCache.MISS and cached is not None:
+            return cached
+
+    access_token = access_token or _square_token_for(merchant_id)
+    joined = _order_inflight.get(order_id)
+    inflight = joined or _square_start_order_fetch(order_id, merchant_id, access_token)
+    # shield: one caller timing out must not cancel the fetch the others are waiting on
+    order_full, items = await asyncio.shield(inflight)
+    if joined is not None and version is not None and isinstance(order_full, dict) and (order_full.get("version") or 0) < version:
+        # The shared fetch started before this version existed; a fetch started from here
+        # on (ours, or one another caller began since) sees it.
+        inflight = _order_inflight.get(order_id) or _square_start_order_fetch(order_id, merchant_id, access_token)
+        order_full, items = await asyncio.shield(inflight)
+    return order_full, items
+
+def _square_start_order_fetch(order_id: str, merchant_id: Optional[str], access_token: Optional[str]) -> asyncio.Future:
+    inflight = asyncio.ensure_future(_square_load_order_items(order_id, merchant_id, access_token))
+    _order_inflight[order_id] = inflight
+    inflight.add_done_callback(lambda f: _order_inflight.pop(order_id) if _order_inflight.get(order_id) is f else None)
+    return inflight
+
+def _find_square_tx_by_payment_id(user_id: str, payment_id: str) -> Optional[dict]:
+    return transactions.by_payment(user_id, "square", payment_id)
 
 # -------------------------
 # Square OAuth (minimal)
@@ -398,15 +2152,13 @@ async def square_callback(code: str):
         "redirect_uri": SQUARE_REDIRECT_URL,
     }
 
-    req = urllib.request.Request(
-        "https://connect.squareup.com/oauth2/token",
-        data=json.dumps(body).encode("utf-8"),
+    async with _square_session().post(
+        f"{SQUARE_API_BASE}/oauth2/token",
+        data=_json_dumps(body),
         headers={"Content-Type": "application/json", "Accept": "application/json"},
-        method="POST",
-    )
-
-    with urllib.request.urlopen(req, timeout=20) as resp:
-        data = json.loads(resp.read().decode("utf-8") or "{}")
+    ) as resp:
+        resp.raise_for_status()
+        data = _json_loads((await resp.read()) or b"{}")
 
     global square_oauth_tokens
     try:
@@ -469,8 +2221,7 @@ def _qbo_request(realm_id: str, path: str, access_token: str) -> dict:
     req = urllib.request.Request(url, headers=headers, method="GET")
     try:
         with urllib.request.urlopen(req, timeout=20) as resp:
-            raw = resp.read().decode("utf-8") or "{}"
-            return json.loads(raw)
+            return _json_loads(resp.read() or b"{}")
     except urllib.error.HTTPError as e:
         try:
             err = e.read().decode("utf-8")
@@ -481,7 +2232,7 @@ def _qbo_request(realm_id: str, path: str, access_token: str) -> dict:
         return {"error": True, "detail": str(e)}
 def _qbo_post(realm_id: str, path: str, access_token: str, payload: dict) -> dict:
     url = f"{QBO_BASE}{path}"
-    body = json.dumps(payload).encode("utf-8")
+    body = _json_dumps(payload)
     headers = {
         "Authorization": f"Bearer {access_token}",
         "Content-Type": "application/json",
@@ -490,8 +2241,7 @@ def _qbo_post(realm_id: str, path: str, access_token: str, payload: dict) -> dic
     req = urllib.request.Request(url, data=body, headers=headers, method="POST")
     try:
         with urllib.request.urlopen(req, timeout=20) as resp:
-            raw = resp.read().decode("utf-8") or "{}"
-            return json.loads(raw)
+            return _json_loads(resp.read() or b"{}")
     except urllib.error.HTTPError as e:
         try:
             err = e.read().decode("utf-8")
@@ -510,8 +2260,7 @@ def _qbo_query(realm_id: str, query: str, access_token: str) -> dict:
     }
     req = urllib.request.Request(url, data=query.encode("utf-8"), headers=headers, method="POST")
     with urllib.request.urlopen(req, timeout=20) as resp:
-        raw = resp.read().decode("utf-8") or "{}"
-        return json.loads(raw)
+        return _json_loads(resp.read() or b"{}")
 
 def _qbo_get_first_item_id(access_token: str, realm_id: str) -> Optional[str]:
     data = _qbo_query(realm_id, "select Id, Name from Item maxresults 1", access_token)
@@ -530,13 +2279,16 @@ def maybe_autopost_to_qbo_from_tx(tx: dict):
     if not item_id:
         return
 
+    currency = tx.get("currency")
     lines = []
     for item in tx["items"]:
-        qty = item.get("quantity") or 0
-        unit_price = item.get("unit_price") or 0
+        qty_scaled = _quantity_to_scaled(item.get("quantity") or 0)
+        unit_minor = _item_unit_minor(item, currency)
+        qty = qty_scaled / QUANTITY_SCALE
+        unit_price = _minor_to_float(unit_minor, currency)
         lines.append({
             "DetailType": "SalesItemLineDetail",
-            "Amount": unit_price * qty,
+            "Amount": _minor_to_float(_line_amount_minor(qty_scaled, unit_minor), currency),
             "Description": item.get("name") or "",
             "SalesItemLineDetail": {
                 "Qty": qty,
@@ -547,7 +2299,7 @@ def maybe_autopost_to_qbo_from_tx(tx: dict):
 
     payload = {
         "Line": lines,
-        "TotalAmt": tx["total"],
+        "TotalAmt": _minor_to_float(_tx_total_minor(tx), currency),
     }
 
     resp = _qbo_post(
@@ -574,7 +2326,7 @@ async def quickbooks_companyinfo(realm_id: str):
 
     # CompanyInfo endpoint expects both company_id and companyinfo_id = realm_id
     path = f"/v3/company/{realm_id}/companyinfo/{realm_id}?minorversion=65"
-    data = _qbo_request(realm_id, path, access_token)
+    data = await _offload("qbo", _qbo_request, realm_id, path, access_token)
 
     # If token expired/revoked, you'll see 401 here
     if isinstance(data, dict) and data.get("status") == 401:
@@ -595,7 +2347,7 @@ QBO_ENV = os.getenv("QBO_ENV", "sandbox")  # "sandbox" or "production"
 # -------------------------
 def _qbo_post_json(realm_id: str, path: str, access_token: str, payload: dict) -> dict:
     url = f"{QBO_BASE}{path}"
-    body = json.dumps(payload).encode("utf-8")
+    body = _json_dumps(payload)
     headers = {
         "Authorization": f"Bearer {access_token}",
         "Content-Type": "application/json",
@@ -604,8 +2356,7 @@ def _qbo_post_json(realm_id: str, path: str, access_token: str, payload: dict) -
     req = urllib.request.Request(url, data=body, headers=headers, method="POST")
     try:
         with urllib.request.urlopen(req, timeout=20) as resp:
-            raw = resp.read().decode("utf-8") or "{}"
-            return json.loads(raw)
+            return _json_loads(resp.read() or b"{}")
     except urllib.error.HTTPError as e:
         try:
             err = e.read().decode("utf-8")
@@ -654,13 +2405,16 @@ def qbo_push_tx(tx: dict) -> dict:
 
     item_id = _qbo_get_or_create_demo_item_id(realm_id, access_token)
 
+    currency = tx.get("currency")
     lines = []
     for it in tx["items"]:
-        qty = float(it.get("quantity") or 1)
-        unit = float(it.get("unit_price") or 0)
+        qty_scaled = _quantity_to_scaled(it.get("quantity") or 1)
+        unit_minor = _item_unit_minor(it, currency)
+        qty = qty_scaled / QUANTITY_SCALE
+        unit = _minor_to_float(unit_minor, currency)
         lines.append({
             "DetailType": "SalesItemLineDetail",
-            "Amount": round(qty * unit, 2),
+            "Amount": _minor_to_float(_line_amount_minor(qty_scaled, unit_minor), currency),
             "SalesItemLineDetail": {
                 "Qty": qty,
                 "UnitPrice": unit,
@@ -671,7 +2425,7 @@ def qbo_push_tx(tx: dict) -> dict:
 
     payload = {
         "Line": lines,
-        "TotalAmt": float(tx.get("total") or 0),
+        "TotalAmt": _minor_to_float(_tx_total_minor(tx), currency),
         "PrivateNote": f"{tx.get('merchant')} payment_id={tx.get('payment_id')}",
     }
 
@@ -700,7 +2454,9 @@ async def quickbooks_exchange(code: str, realmId: str):
         "redirect_uri": QBO_REDIRECT_URI,
     }
 
-    r = requests.post(
+    r = await _offload(
+        "qbo",
+        requests.post,
         token_url,
         data=data,
         headers={"Accept": "application/json"},
@@ -719,7 +2475,7 @@ async def quickbooks_exchange(code: str, realmId: str):
         except (TypeError, ValueError):
             pass
     qbo_tokens[str(realmId)] = tok
-    _db_save_qbo_token(realmId, tok)
+    await asyncio.to_thread(_db_save_qbo_token, realmId, tok)
     return {"ok": True, "realm_id": realmId}
 
 def _qbo_get_or_create_item(access_token: str, realm_id: str) -> str:
@@ -777,25 +2533,40 @@ async def stripe_webhook(request: Request):
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Stripe webhook error: {str(e)}")
 
-    event_type = event["type"]
+    # Claimed before handling, so a redelivery racing this one (in any worker process) is
+    # turned away; released again if handling fails, so Stripe's retry is processed.
+    event_id = event["id"]
+    if event_id and not await asyncio.to_thread(_dedup_record, "stripe", event_id):
+        return {"ok": True, "deduped_event": True}
+    try:
+        await _stripe_apply_event(event)
+    except BaseException:
+        if event_id:
+            await asyncio.to_thread(_dedup_forget, "stripe", event_id)
+        raise
+    return {"ok": True}
 
+async def _stripe_apply_event(event) -> None:
+    event_type = event["type"]
     if event_type == "checkout.session.completed":
         session = event["data"]["object"]
         user_id = session.get("client_reference_id") or "demo_user"
+        currency = (session.get("currency") or "usd").upper()
 
-        line_items = stripe.checkout.Session.list_line_items(session["id"], limit=100)
+        line_items = await _offload("stripe", stripe.checkout.Session.list_line_items, session["id"], limit=100)
         items = []
         for li in line_items.get("data", []):
             price = li.get("price") or {}
             product_name = li.get("description") or ""
             quantity = li.get("quantity") or 1
-            unit_amount = (price.get("unit_amount") or 0) / 100
+            unit_amount = price.get("unit_amount") or 0
             items.append(
                 {
                     "sku": (price.get("product") or ""),
                     "name": product_name,
                     "quantity": quantity,
-                    "unit_price": unit_amount,
+                    "unit_price": _minor_to_float(unit_amount, currency),
+                    "unit_price_minor": unit_amount,
                 }
             )
 
@@ -803,18 +2574,221 @@ async def stripe_webhook(request: Request):
             "id": str(uuid.uuid4()),
             "user_id": user_id,
             "merchant": "stripe",
-            "payment_id": session.get("payment_intent"),
+            # Subscription, setup and zero-amount sessions carry no payment_intent; keying
+            # them all on "" would make each one overwrite the user's previous receipt.
+            "payment_id": session.get("payment_intent") or session["id"],
             "timestamp": session.get("created"),
-            "currency": (session.get("currency") or "usd").upper(),
-            "total": (session.get("amount_total") or 0) / 100,
+            "currency": currency,
+            "total": _minor_to_float(session.get("amount_total") or 0, currency),
+            "total_minor": session.get("amount_total") or 0,
             "items": items,
             "meta": {"stripe_session": session},
         }
 
-        transactions.append(transaction)
-        return {"ok": True}
+        transactions.add(transaction)
+        await _db_write_tx_async(transaction)
 
-    return {"ok": True}
+# -------------------------
+# Webhook event dedup
+# -------------------------
+# processed_events (SQLite) is the source of truth and is shared by every worker process.
+# The Bloom filter in front only answers "definitely not seen by this process", letting
+# brand-new events skip the SELECT; a miss there still goes through the atomic
+# INSERT OR IGNORE, so correctness never depends on the filter. Rows older than
+# DEDUP_RETENTION_SECONDS (providers stop redelivering after ~3 days) are pruned and
+# the filter is rebuilt from what is left.
+DEDUP_RETENTION_SECONDS = _env_int("DEDUP_RETENTION_SECONDS", 7 * 24 * 3600)
+DEDUP_PRUNE_INTERVAL_SECONDS = _env_int("DEDUP_PRUNE_INTERVAL_SECONDS", 3600)
+DEDUP_BLOOM_CAPACITY = _env_int("DEDUP_BLOOM_CAPACITY", 1_000_000)
+
+class _BloomFilter:
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self._m = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self._k = max(1, int(round(self._m / capacity * math.log(2))))
+        self._bits = bytearray((self._m + 7) // 8)
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self._m for i in range(self._k))
+
+    def add(self, key: str) -> None:
+        for pos in self._positions(key):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+_dedup_filter = _BloomFilter(DEDUP_BLOOM_CAPACITY)
+
+def _dedup_key(source: str, event_id: str) -> str:
+    return f"{source}:{event_id}"
+
+def _dedup_seen(source: str, event_id: str) -> bool:
+    if _dedup_key(source, event_id) not in _dedup_filter:
+        return False
+    with _db.reader() as conn:
+        row = conn.execute(
+            "SELECT 1 FROM processed_events WHERE source=? AND event_id=?",
+            (source, event_id),
+        ).fetchone()
+    return row is not None
+
+def _dedup_claim(conn: sqlite3.Connection, source: str, event_id: str) -> bool:
+    """Record the event id on conn (caller commits). False if it was already recorded."""
+    cur = conn.execute(
+        "INSERT OR IGNORE INTO processed_events (source, event_id, received_at) VALUES (?, ?, ?)",
+        (source, event_id, int(time.time())),
+    )
+    _dedup_filter.add(_dedup_key(source, event_id))
+    return cur.rowcount > 0
+
+def _dedup_record(source: str, event_id: str) -> bool:
+    """Claim the event id in its own transaction. False if it was already recorded."""
+    with _db.writer() as conn:
+        return _dedup_claim(conn, source, event_id)
+
+def _dedup_forget(source: str, event_id: str) -> None:
+    # The id stays in the Bloom filter; that only costs a SELECT until the next rebuild.
+    with _db.writer() as conn:
+        conn.execute("DELETE FROM processed_events WHERE source=? AND event_id=?", (source, event_id))
+
+def _dedup_rebuild_filter() -> int:
+    rebuilt = _BloomFilter(DEDUP_BLOOM_CAPACITY)
+    count = 0
+    with _db.reader() as conn:
+        for source, event_id in conn.execute("SELECT source, event_id FROM processed_events"):
+            rebuilt.add(_dedup_key(source, event_id))
+            count += 1
+    global _dedup_filter
+    _dedup_filter = rebuilt
+    return count
+
+def _dedup_prune() -> int:
+    with _db.writer() as conn:
+        cur = conn.execute(
+            "DELETE FROM processed_events WHERE received_at<?",
+            (int(time.time()) - DEDUP_RETENTION_SECONDS,),
+        )
+    return cur.rowcount
+
+async def _dedup_pruner() -> None:
+    while True:
+        await asyncio.sleep(DEDUP_PRUNE_INTERVAL_SECONDS)
+        try:
+            pruned = await asyncio.to_thread(_dedup_prune)
+            # A Bloom filter can't forget keys, so start a fresh one from the surviving rows.
+            # Events added while it is rebuilt only lose their fast path, not their dedup.
+            await asyncio.to_thread(_dedup_rebuild_filter)
+            print("Dedup store pruned", pruned, "events")
+        except Exception as e:
+            print("Dedup prune failed:", repr(e))
+
+_dedup_pruner_task: Optional[asyncio.Task] = None
+
+async def _start_dedup_pruner() -> None:
+    global _dedup_pruner_task
+    await asyncio.to_thread(_dedup_rebuild_filter)
+    _dedup_pruner_task = asyncio.create_task(_dedup_pruner())
+
+async def _stop_dedup_pruner() -> None:
+    if _dedup_pruner_task is not None:
+        _dedup_pruner_task.cancel()
+        await asyncio.gather(_dedup_pruner_task, return_exceptions=True)
+
+_startup_hooks.append(_start_dedup_pruner)
+_shutdown_hooks.append(_stop_dedup_pruner)
+
+# -------------------------
+# Webhook job queue (SQLite)
+# -------------------------
+# Webhooks are acknowledged as soon as the raw event is durably queued. Workers claim a
+# job by pushing its visible_at into the future; if a worker dies mid-job the claim
+# lapses and the job is picked up again (at-least-once). Jobs that keep failing are
+# moved to webhook_dead_letters after WEBHOOK_MAX_ATTEMPTS. These helpers take the DB
+# write lock, which a receipt group commit holds for its whole batch, so async code
+# calls them through asyncio.to_thread rather than on the event loop.
+SQUARE_WEBHOOK_WORKERS = _env_int("SQUARE_WEBHOOK_WORKERS", 4)
+WEBHOOK_VISIBILITY_TIMEOUT_SECONDS = _env_int("WEBHOOK_VISIBILITY_TIMEOUT_SECONDS", 60)
+WEBHOOK_MAX_ATTEMPTS = _env_int("WEBHOOK_MAX_ATTEMPTS", 5)
+WEBHOOK_POLL_INTERVAL_SECONDS = _env_int("WEBHOOK_POLL_INTERVAL_SECONDS", 1)
+
+_webhook_event: Optional[asyncio.Event] = None
+
+def _webhook_enqueue(source: str, event_id: Optional[str], payload_text: str) -> bool:
+    """Durably queue a raw event. Returns False if the event was already received."""
+    if event_id and _dedup_seen(source, event_id):
+        return False
+    now = time.time()
+    with _db.writer() as conn:
+        # Claim the event id and queue the job in one transaction, so a redelivery is either
+        # rejected here or the original is guaranteed to be on the queue.
+        if event_id and not _dedup_claim(conn, source, event_id):
+            return False
+        cur = conn.execute(
+            """
+            INSERT OR IGNORE INTO webhook_jobs (source, event_id, payload, attempts, visible_at, created_at)
+            VALUES (?, ?, ?, 0, ?, ?)
+            """,
+            (source, event_id, payload_text, now, now),
+        )
+    return cur.rowcount > 0
+
+def _webhook_claim(source: str):
+    """Claim the next visible job, hiding it for the visibility timeout."""
+    now = time.time()
+    with _db.writer() as conn:
+        row = conn.execute(
+            """
+            UPDATE webhook_jobs
+            SET attempts = attempts + 1, visible_at = ?
+            WHERE id = (
+              SELECT id FROM webhook_jobs
+              WHERE source=? AND visible_at<=?
+              ORDER BY visible_at, id
+              LIMIT 1
+            )
+            RETURNING id, event_id, payload, attempts
+            """,
+            (now + WEBHOOK_VISIBILITY_TIMEOUT_SECONDS, source, now),
+        ).fetchone()
+    return row
+
+def _webhook_ack(job_id: int) -> None:
+    with _db.writer() as conn:
+        conn.execute("DELETE FROM webhook_jobs WHERE id=?", (job_id,))
+
+def _webhook_fail(job_id: int, attempts: int, error: str) -> None:
+    with _db.writer() as conn:
+        if attempts >= WEBHOOK_MAX_ATTEMPTS:
+            conn.execute(
+                """
+                INSERT INTO webhook_dead_letters (source, event_id, payload, attempts, last_error, created_at, failed_at)
+                SELECT source, event_id, payload, attempts, ?, created_at, ?
+                FROM webhook_jobs WHERE id=?
+                """,
+                (error, time.time(), job_id),
+            )
+            conn.execute("DELETE FROM webhook_jobs WHERE id=?", (job_id,))
+        else:
+            # Exponential backoff between attempts, capped at 5 minutes.
+            retry_at = time.time() + min(2 ** attempts, 300)
+            conn.execute(
+                "UPDATE webhook_jobs SET visible_at=?, last_error=? WHERE id=?",
+                (retry_at, error, job_id),
+            )
+
+def _webhook_wakeup() -> None:
+    if _webhook_event is not None:
+        _webhook_event.set()
+
+async def _webhook_wait(timeout: float) -> None:
+    try:
+        await asyncio.wait_for(_webhook_event.wait(), timeout=timeout)
+    except asyncio.TimeoutError:
+        pass
+    _webhook_event.clear()
 
 # -------------------------
 # Square Webhook
@@ -823,11 +2797,6 @@ async def stripe_webhook(request: Request):
 async def square_webhook(request: Request):
     body_bytes = await request.body()
 
-    try:
-        payload = await request.json()
-    except Exception:
-        payload = None
-
     if SQUARE_WEBHOOK_SIGNATURE_KEY:
         notification_url = os.getenv("SQUARE_WEBHOOK_NOTIFICATION_URL") or _request_public_url(request)
         expected = _square_expected_signature(SQUARE_WEBHOOK_SIGNATURE_KEY, notification_url, body_bytes)
@@ -835,30 +2804,54 @@ async def square_webhook(request: Request):
         if not hmac.compare_digest(expected, provided):
             raise HTTPException(status_code=401, detail="Invalid Square webhook signature")
 
+    # Decode the bytes we already buffered for the HMAC instead of request.json() re-reading them.
+    try:
+        payload = _json_loads(body_bytes)
+    except ValueError:
+        payload = None
+
     if not isinstance(payload, dict):
         return {"ok": True}
 
-    event_type = payload.get("type")
     event_id = payload.get("event_id")
-
+    # Acknowledge fast: enrichment + persistence happen on the queue workers.
+    if not await asyncio.to_thread(_webhook_enqueue, "square", event_id, body_bytes.decode("utf-8")):
+        return {"ok": True, "deduped_event": True}
+    _webhook_wakeup()
     print("✅ Square webhook received")
-    print("Type:", event_type)
-
-    # Use the correct merchant OAuth token for Square API calls (webhook runs per-merchant)
-    merchant_id = (payload or {}).get("merchant_id")
+    print("Type:", payload.get("type"))
+    return {"ok": True, "queued": True}
+
+async def _square_process_event(payload: dict) -> dict:
+    """Enrich and persist one Square event. Runs on a queue worker; raising means retry."""
+    # Use the correct merchant OAuth token for Square API calls (webhook runs per-merchant).
+    # It is passed down explicitly: workers interleave at every await, so a shared global
+    # would let one merchant's calls go out with another's token.
+    access_token = _square_token_for((payload or {}).get("merchant_id"))
+    return await _square_apply_event(payload, access_token)
+
+# payment.created and payment.updated for one payment are usually woken together by the
+# shared order fetch; find-or-create runs under a per-payment lock so only one of them
+# creates the transaction and the other updates it.
+_square_payment_locks: Dict[tuple, list] = {}  # (user_id, payment_id) -> [lock, holders]
+
+@asynccontextmanager
+async def _square_payment_lock(user_id: str, payment_id: str):
+    key = (user_id, payment_id)
+    entry = _square_payment_locks.setdefault(key, [asyncio.Lock(), 0])
+    entry[1] += 1
     try:
-        global square_oauth_tokens
-    except NameError:
-        square_oauth_tokens = {}
-    if merchant_id and merchant_id in square_oauth_tokens:
-        global SQUARE_ACCESS_TOKEN
-        tok = square_oauth_tokens[merchant_id] or {}
-        SQUARE_ACCESS_TOKEN = tok.get("access_token") or SQUARE_ACCESS_TOKEN
-
-    if event_id and event_id in processed_square_event_ids:
-        return {"ok": True, "deduped_event": True}
-    if event_id:
-        processed_square_event_ids.add(event_id)
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del _square_payment_locks[key]
+
+async def _square_apply_event(payload: dict, access_token: Optional[str]) -> dict:
+    event_type = payload.get("type")
+    event_id = payload.get("event_id")
+    merchant_id = payload.get("merchant_id")
 
     data = payload.get("data") or {}
     obj = data.get("object") or {}
@@ -879,22 +2872,19 @@ async def square_webhook(request: Request):
 
         items: List[dict] = []
         order_full = None
-        if SQUARE_ACCESS_TOKEN:
-            order_full = _square_get_order(order_id)
-            if isinstance(order_full, dict):
-                items = _order_to_items(order_full)
+        if access_token:
+            order_full, items = await _square_fetch_order_items(order_id, merchant_id, order.get("version"), access_token)
 
         # Update existing transaction (created from payment.*) by order_id
-        for t in transactions:
+        t = await asyncio.to_thread(transactions.by_order, user_id, "square", order_id)
+        if t is not None:
             meta = t.get("meta") or {}
-            if t.get("merchant") == "square" and meta.get("square_order_id") == order_id:
-                if items:
-                    t["items"] = items
-                meta["square_order"] = order_full
-                meta["square_event_type"] = event_type
-                meta["square_event_id"] = event_id
-                t["meta"] = meta
-                return {"ok": True, "updated_existing": True}
+            if items:
+                t["items"] = items
+            meta["square_order"] = order_full
+            t["meta"] = meta
+            await _db_write_tx_async(t)
+            return {"ok": True, "updated_existing": True}
 
         return {"ok": True, "no_matching_tx": True}
 
@@ -907,6 +2897,7 @@ async def square_webhook(request: Request):
         amount_money = payment.get("amount_money") or {}
         currency = (amount_money.get("currency") or "USD").upper()
         total = _money_to_float(amount_money)
+        total_minor = _money_to_minor(amount_money)
 
         ts = int(time.time())
         order_id = payment.get("order_id") or payment.get("associated_order_id")
@@ -914,82 +2905,118 @@ async def square_webhook(request: Request):
         # Try to fetch the full order + item lines (often succeeds on payment.updated)
         items: List[dict] = []
         order_full = None
-        if order_id and SQUARE_ACCESS_TOKEN:
-            order_full = _square_get_order(order_id)
-            if isinstance(order_full, dict):
-                items = _order_to_items(order_full)
+        if order_id and access_token:
+            order_full, items = await _square_fetch_order_items(order_id, merchant_id, access_token=access_token)
 
         payment_id = payment.get("id") or ""
-        existing = _find_square_tx_by_payment_id(payment_id)
-        if existing:
-            if items:
-                existing["items"] = items
-            if order_full is not None:
-                existing["meta"]["square_order"] = order_full
-            existing["meta"]["square_event_type"] = event_type
-            existing["meta"]["square_event_id"] = event_id
-            existing["meta"]["square_order_id"] = order_id or existing["meta"].get("square_order_id")
-            _db_write_tx(existing)
-            return {"ok": True, "updated_existing": True}
+        async with _square_payment_lock(user_id, payment_id):
+            existing = await asyncio.to_thread(_find_square_tx_by_payment_id, user_id, payment_id)
+            if existing:
+                if items:
+                    existing["items"] = items
+                if order_full is not None:
+                    existing["meta"]["square_order"] = order_full
+                existing["meta"]["square_order_id"] = order_id or existing["meta"].get("square_order_id")
+                transactions.reindex(existing)
+                await _db_write_tx_async(existing)
+                return {"ok": True, "updated_existing": True}
 
-        tx = {
-            "id": str(uuid.uuid4()),
-            "user_id": user_id,
-            "merchant": "square",
-            "payment_id": payment_id,
-            "timestamp": ts,
-            "currency": currency,
-            "total": total,
-            "items": items,
-            "meta": {
-                "square_event_type": event_type,
-                "square_event_id": event_id,
-                "square_order_id": order_id,
-                "square_payment": payment,
-                "square_order": order_full,
-            },
-        }
-        transactions.append(tx)
-        _db_write_tx(tx)
-        maybe_autopost_to_qbo_from_tx(tx)
+            tx = {
+                "id": str(uuid.uuid4()),
+                "user_id": user_id,
+                "merchant": "square",
+                "payment_id": payment_id,
+                "timestamp": ts,
+                "currency": currency,
+                "total": total,
+                "total_minor": total_minor,
+                "items": items,
+                "meta": {
+                    "square_order_id": order_id,
+                    "square_merchant_id": merchant_id,
+                    "square_payment": payment,
+                    "square_order": order_full,
+                },
+            }
+            transactions.add(tx)
+            await _db_write_tx_async(tx)
+        try:
+            await _offload("qbo", maybe_autopost_to_qbo_from_tx, tx)
+        except Exception as e:
+            # The receipt is committed; failing the job now would only send the retry down
+            # the updated_existing branch, which never autoposts. Log it instead.
+            print(f"QBO autopost failed for transaction {tx['id']}:", repr(e))
         return {"ok": True, "created": True}
 
 
     return {"ok": True, "ignored": True}
 
-from fastapi.responses import HTMLResponse
-
-@app.get("/demo/receipts", response_class=HTMLResponse)
-async def demo_receipts(user_id: str = "demo_user", limit: int = 200):
-    """
-    Simple demo UI: renders receipt_items as an HTML table (spreadsheet vibe).
-    """
-    conn = _db_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT
-          ts, merchant, payment_id, order_id, item_name, sku, quantity, unit_price, currency, total
-        FROM receipt_items
-        WHERE user_id=?
-        ORDER BY ts DESC
-        LIMIT ?
-        """,
-        (user_id, int(limit)),
-    )
-    rows = cur.fetchall()
-    conn.close()
+async def _square_worker(worker_no: int) -> None:
+    queue_errors = 0
+    while True:
+        try:
+            await _square_work_one(worker_no)
+            queue_errors = 0
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # The queue itself failed (e.g. "database is locked" past the busy timeout).
+            # A claimed job's visibility lapses and it is retried, so back off and keep
+            # this worker alive rather than letting the endpoint queue jobs nobody runs.
+            queue_errors += 1
+            delay = min(WEBHOOK_POLL_INTERVAL_SECONDS * 2 ** queue_errors, 60)
+            print(f"Square worker {worker_no}: queue error, retrying in {delay}s:", repr(e))
+            await asyncio.sleep(delay)
+
+async def _square_work_one(worker_no: int) -> None:
+    job = await asyncio.to_thread(_webhook_claim, "square")
+    if job is None:
+        await _webhook_wait(WEBHOOK_POLL_INTERVAL_SECONDS)
+        return
 
-    def esc(s):
-        s = "" if s is None else str(s)
-        return (
-            s.replace("&", "&amp;")
-             .replace("<", "&lt;")
-             .replace(">", "&gt;")
-             .replace('"', "&quot;")
+    job_id, event_id, payload_text, attempts = job
+    try:
+        payload = _json_loads(payload_text)
+        result = await asyncio.wait_for(
+            _square_process_event(payload), timeout=WEBHOOK_VISIBILITY_TIMEOUT_SECONDS
         )
+    except asyncio.CancelledError:
+        # Shutting down mid-job: the claim lapses and another worker picks it up.
+        raise
+    except Exception as e:
+        print(f"Square worker {worker_no}: job {job_id} (event {event_id}) failed:", repr(e))
+        await asyncio.to_thread(_webhook_fail, job_id, attempts, repr(e))
+        return
+    await asyncio.to_thread(_webhook_ack, job_id)
+    print(f"Square worker {worker_no}: job {job_id} done:", result)
+
+_webhook_workers: List[asyncio.Task] = []
+
+async def _start_webhook_workers() -> None:
+    global _webhook_event
+    _webhook_event = asyncio.Event()
+    for n in range(SQUARE_WEBHOOK_WORKERS):
+        _webhook_workers.append(asyncio.create_task(_square_worker(n)))
+
+async def _stop_webhook_workers() -> None:
+    for task in _webhook_workers:
+        task.cancel()
+    await asyncio.gather(*_webhook_workers, return_exceptions=True)
+    _webhook_workers.clear()
 
-    html = """
+_startup_hooks.append(_start_webhook_workers)
+_shutdown_hooks.append(_stop_webhook_workers)
+
+from fastapi.responses import HTMLResponse, StreamingResponse
+
+DEMO_RECEIPTS_CHUNK_ROWS = _env_int("DEMO_RECEIPTS_CHUNK_ROWS", 500)
+
+_HTML_ESCAPES = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#x27;"})
+
+def _esc(s) -> str:
+    return "" if s is None else str(s).translate(_HTML_ESCAPES)
+
+_DEMO_RECEIPTS_HEAD = """
 <!doctype html>
 <html>
 <head>
@@ -1031,37 +3058,279 @@ async def demo_receipts(user_id: str = "demo_user", limit: int = 200):
       </thead>
       <tbody>
 """
-    for r in rows:
-        ts, merchant, payment_id, order_id, item_name, sku, qty, unit_price, currency, total = r
-        html += "<tr>"
-        html += f"<td class='mono'>{esc(ts)}</td>"
-        html += f"<td><span class='pill'>{esc(merchant)}</span></td>"
-        html += f"<td class='mono'>{esc(payment_id)}</td>"
-        html += f"<td class='mono'>{esc(order_id)}</td>"
-        html += f"<td>{esc(item_name)}</td>"
-        html += f"<td class='mono'>{esc(sku)}</td>"
-        html += f"<td class='right'>{esc(qty)}</td>"
-        html += f"<td class='right'>{esc(unit_price)}</td>"
-        html += f"<td class='mono'>{esc(currency)}</td>"
-        html += f"<td class='right'>{esc(total)}</td>"
-        html += "</tr>"
-
-    html += """
+
+_DEMO_RECEIPTS_TAIL = """
       </tbody>
     </table>
   </div>
 </body>
 </html>
 """
-    return HTMLResponse(html)
+
+def _demo_receipt_row(row: tuple) -> str:
+    ts, merchant, payment_id, order_id, item_name, sku, qty_scaled, unit_minor, currency, total_minor = row
+    return (
+        f"<tr><td class='mono'>{_esc(ts)}</td>"
+        f"<td><span class='pill'>{_esc(merchant)}</span></td>"
+        f"<td class='mono'>{_esc(payment_id)}</td>"
+        f"<td class='mono'>{_esc(order_id)}</td>"
+        f"<td>{_esc(item_name)}</td>"
+        f"<td class='mono'>{_esc(sku)}</td>"
+        f"<td class='right'>{_format_quantity(qty_scaled)}</td>"
+        f"<td class='right'>{_format_minor(unit_minor, currency)}</td>"
+        f"<td class='mono'>{_esc(currency)}</td>"
+        f"<td class='right'>{_format_minor(total_minor, currency)}</td></tr>"
+    )
+
+def _demo_receipts_html(user_id: str, limit: int) -> Iterator[str]:
+    # Sync generator: StreamingResponse runs it on the threadpool, so the SQLite reads don't
+    # block the event loop, and each chunk of rows is sent as soon as it is rendered. Receipts
+    # are keyset-paged like TransactionStore.for_user and the reader goes back to the pool
+    # before each chunk is yielded, so a client that stops reading doesn't hold a connection.
+    yield _DEMO_RECEIPTS_HEAD
+    remaining = int(limit)
+    after = None
+    while remaining > 0:
+        bound, params = ("AND (ts, id) < (?, ?)", (user_id, *after)) if after else ("", (user_id,))
+        with _shards.reader(user_id) as conn:
+            # Every receipt renders at least one row, so `remaining` receipts is always enough.
+            receipts = conn.execute(
+                f"""
+                SELECT id, ts, merchant, payment_id, order_id, currency, total_minor FROM receipts
+                WHERE user_id=? {bound}
+                ORDER BY ts DESC, id DESC
+                LIMIT ?
+                """,
+                (*params, min(remaining, DEMO_RECEIPTS_CHUNK_ROWS)),
+            ).fetchall()
+            lines: Dict[str, list] = {}
+            if receipts:
+                for receipt_id, *line in conn.execute(
+                    f"""
+                    SELECT receipt_id, item_name, sku, quantity_scaled, unit_price_minor FROM receipt_lines
+                    WHERE receipt_id IN ({",".join("?" * len(receipts))})
+                    ORDER BY receipt_id, line_no
+                    """,
+                    [r[0] for r in receipts],
+                ):
+                    lines.setdefault(receipt_id, []).append(line)
+        if not receipts:
+            break
+        rows = [
+            (ts, merchant, payment_id, order_id, item_name, sku, qty_scaled, unit_minor, currency, total_minor)
+            for receipt_id, ts, merchant, payment_id, order_id, currency, total_minor in receipts
+            for item_name, sku, qty_scaled, unit_minor in lines.get(receipt_id) or [("(no items yet)", None, 0, 0)]
+        ][:remaining]
+        remaining -= len(rows)
+        after = (receipts[-1][1], receipts[-1][0])
+        yield "".join(map(_demo_receipt_row, rows))
+    yield _DEMO_RECEIPTS_TAIL
+
+@app.get("/demo/receipts", response_class=HTMLResponse)
+async def demo_receipts(request: Request, user_id: str = "demo_user", limit: int = 200):
+    """
+    Simple demo UI: renders receipt lines as an HTML table (spreadsheet vibe).
+    """
+    etag = await _user_etag(request, user_id)
+    if _etag_matches(request, etag):
+        return _not_modified(etag)
+    return StreamingResponse(
+        _demo_receipts_html(user_id, limit),
+        media_type="text/html; charset=utf-8",
+        headers={"ETag": etag, "Cache-Control": "private, no-cache"},
+    )
 
 
 # -------------------------
 # API your app calls
 # -------------------------
+TRANSACTIONS_PAGE_DEFAULT = _env_int("TRANSACTIONS_PAGE_DEFAULT", 100)
+TRANSACTIONS_PAGE_MAX = _env_int("TRANSACTIONS_PAGE_MAX", 500)
+
+def _encode_cursor(key: tuple) -> str:
+    raw = _json_dumps(list(key))
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def _decode_cursor(cursor: str) -> tuple:
+    try:
+        ts, tx_id = _json_loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return int(ts), str(tx_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+# view=summary (the default) leaves out meta, which holds the raw Stripe/Square objects and
+# is usually most of the bytes; fetch it per transaction from /api/transactions/{tx_id}.
+_TX_SUMMARY_FIELDS = ("id", "user_id", "merchant", "payment_id", "timestamp", "currency", "total", "total_minor", "items")
+_TX_FULL_FIELDS = _TX_SUMMARY_FIELDS + ("meta",)
+
+def _tx_fields(view: str, fields: Optional[str]) -> tuple:
+    if fields:
+        wanted = tuple(f.strip() for f in fields.split(",") if f.strip())
+        unknown = [f for f in wanted if f not in _TX_FULL_FIELDS]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+        return wanted
+    if view == "full":
+        return _TX_FULL_FIELDS
+    if view == "summary":
+        return _TX_SUMMARY_FIELDS
+    raise HTTPException(status_code=400, detail="view must be summary or full")
+
+def _project_tx(tx: dict, fields: tuple) -> dict:
+    return {f: tx[f] for f in fields if f in tx}
+
+NDJSON_LINES_PER_CHUNK = _env_int("NDJSON_LINES_PER_CHUNK", 100)
+
+def _transactions_ndjson(txs: Iterator[dict], wanted: tuple) -> Iterator[bytes]:
+    # StreamingResponse pulls the next chunk only once the previous one has been sent, so a
+    # slow client throttles the SQLite paging behind it instead of letting output pile up.
+    buf: List[bytes] = []
+    for tx in txs:
+        buf.append(_json_dumps(_project_tx(tx, wanted)))
+        if len(buf) >= NDJSON_LINES_PER_CHUNK:
+            yield b"\n".join(buf) + b"\n"
+            buf.clear()
+    if buf:
+        yield b"\n".join(buf) + b"\n"
+
 @app.get("/api/transactions")
-async def get_transactions(user_id: str = "demo_user"):
-    return [t for t in transactions if t.get("user_id") == user_id]
+async def get_transactions(
+    request: Request,
+    user_id: str = "demo_user",
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    since: Optional[int] = None,
+    until: Optional[int] = None,
+    view: str = "summary",
+    fields: Optional[str] = None,
+):
+    """
+    Oldest first. Pass next_cursor back as cursor to get the following page; it is null
+    on the last page. since/until are unix seconds (since inclusive, until exclusive).
+    fields=id,total,... picks top-level keys and overrides view.
+
+    With Accept: application/x-ndjson the whole range (or the first `limit`) is streamed
+    instead, one transaction per line, with no page cap and no next_cursor.
+    """
+    wanted = _tx_fields(view, fields)
+    after = _decode_cursor(cursor) if cursor else None
+    etag = await _user_etag(request, user_id)
+    if _etag_matches(request, etag):
+        return _not_modified(etag)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if "application/x-ndjson" in (request.headers.get("accept") or ""):
+        txs = transactions.for_user(
+            user_id, page_size=TRANSACTIONS_PAGE_MAX, after=after, since=since, until=until, with_meta="meta" in wanted
+        )
+        if limit is not None:
+            txs = itertools.islice(txs, max(0, int(limit)))
+        return StreamingResponse(_transactions_ndjson(txs, wanted), media_type="application/x-ndjson", headers=headers)
+
+    limit = max(1, min(int(limit or TRANSACTIONS_PAGE_DEFAULT), TRANSACTIONS_PAGE_MAX))
+    # One extra row tells us whether another page exists without a COUNT.
+    found = await asyncio.to_thread(
+        transactions.page, user_id, limit + 1, after=after, since=since, until=until, with_meta="meta" in wanted
+    )
+    next_cursor = _encode_cursor((found[limit - 1]["timestamp"], found[limit - 1]["id"])) if len(found) > limit else None
+    return _json_response(
+        {"transactions": [_project_tx(tx, wanted) for tx in found[:limit]], "next_cursor": next_cursor},
+        headers=headers,
+    )
+
+@app.get("/api/transactions/changes")
+async def get_transaction_changes(
+    request: Request,
+    user_id: str = "demo_user",
+    since: int = 0,
+    cursor: Optional[str] = None,
+    limit: int = TRANSACTIONS_PAGE_DEFAULT,
+    view: str = "summary",
+    fields: Optional[str] = None,
+):
+    """
+    Receipts created or modified since change sequence `since`, oldest change first.
+    While next_cursor is set, pass it back as cursor for the rest of the delta; once it is
+    null the client is caught up and should store `seq` for its next since=.
+    """
+    wanted = _tx_fields(view, fields)
+    limit = max(1, min(int(limit), TRANSACTIONS_PAGE_MAX))
+    after = _decode_cursor(cursor) if cursor else None
+    etag = await _user_etag(request, user_id)
+    if _etag_matches(request, etag):
+        return _not_modified(etag)
+    changed, version = await asyncio.to_thread(
+        transactions.changes, user_id, limit + 1, since=since, after=after, with_meta="meta" in wanted
+    )
+    next_cursor = None
+    if len(changed) > limit:
+        seq, tx = changed[limit - 1]
+        next_cursor = _encode_cursor((seq, tx["id"]))
+    return _json_response(
+        {
+            "transactions": [_project_tx(tx, wanted) for _, tx in changed[:limit]],
+            "next_cursor": next_cursor,
+            "seq": version,
+        },
+        headers={"ETag": etag, "Cache-Control": "private, no-cache"},
+    )
+
+@app.get("/api/transactions/{tx_id}")
+async def get_transaction(
+    request: Request, tx_id: str, user_id: str = "demo_user", view: str = "full", fields: Optional[str] = None
+):
+    wanted = _tx_fields(view, fields)
+    etag = await _user_etag(request, user_id)
+    if _etag_matches(request, etag):
+        return _not_modified(etag)
+    tx = await asyncio.to_thread(transactions.get, user_id, tx_id)
+    if tx is None:
+        raise HTTPException(status_code=404, detail="Transaction not found")
+    return _json_response(_project_tx(tx, wanted), headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+
+def _rollup_summary(user_id: str, start: Optional[str], end: Optional[str], bucket: str) -> dict:
+    with _shards.reader(user_id) as conn:
+        return _db_rollup_summary(conn, user_id, start, end, bucket)
+
+def _report_day(value: Optional[str], name: str) -> Optional[str]:
+    if value is None:
+        return None
+    try:
+        return time.strftime("%Y-%m-%d", time.strptime(value, "%Y-%m-%d"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} must be a YYYY-MM-DD date")
+
+@app.get("/api/reports/summary")
+async def get_report_summary(
+    request: Request,
+    user_id: str = "demo_user",
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    bucket: str = "day",
+):
+    """
+    Revenue per merchant and units per SKU, grouped by day, week (Monday start) or month
+    of the receipt's UTC date, between start and end inclusive (both YYYY-MM-DD, optional).
+    """
+    if bucket not in _ROLLUP_BUCKETS:
+        raise HTTPException(status_code=400, detail=f"bucket must be one of: {', '.join(_ROLLUP_BUCKETS)}")
+    start, end = _report_day(start, "start"), _report_day(end, "end")
+    etag = await _user_etag(request, user_id)
+    if _etag_matches(request, etag):
+        return _not_modified(etag)
+    summary = await asyncio.to_thread(_rollup_summary, str(user_id), start, end, bucket)
+    return _json_response(
+        {"bucket": bucket, "start": start, "end": end, **summary},
+        headers={"ETag": etag, "Cache-Control": "private, no-cache"},
+    )
+
+def _square_backfill_candidates(user_id: str, limit: int) -> List[dict]:
+    found = []
+    for t in transactions.for_user(user_id, newest_first=True):
+        if len(found) >= limit:
+            break
+        if t.get("merchant") == "square":
+            found.append(t)
+    return found
 
 @app.post("/api/square/backfill")
 async def square_backfill(user_id: str = "demo_user", limit: int = 50):
@@ -1071,15 +3340,8 @@ async def square_backfill(user_id: str = "demo_user", limit: int = 50):
     updated = 0
     checked = 0
 
-    # newest first
-    for t in reversed(transactions):
-        if checked >= limit:
-            break
-        if t.get("user_id") != user_id:
-            continue
-        if t.get("merchant") != "square":
-            continue
-
+    # newest first; the walk reads SQLite, so collect the candidates off the loop
+    for t in await asyncio.to_thread(_square_backfill_candidates, user_id, limit):
         checked += 1
 
         meta = t.get("meta") or {}
@@ -1091,13 +3353,13 @@ async def square_backfill(user_id: str = "demo_user", limit: int = 50):
         if t.get("items") and meta.get("square_order"):
             continue
 
-        order_full = _square_get_order(order_id)
+        order_full, items = await _square_fetch_order_items(order_id, meta.get("square_merchant_id"))
         if isinstance(order_full, dict):
-            items = _order_to_items(order_full)
             if items:
                 t["items"] = items
             meta["square_order"] = order_full
             t["meta"] = meta
+            await _db_write_tx_async(t)
             updated += 1
 
     return {"ok": True, "checked": checked, "updated": updated}
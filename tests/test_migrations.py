@@ -0,0 +1,63 @@
+import os
+import sqlite3
+import sys
+import tempfile
+
+import pytest
+
+# main opens DB_PATH at import; point it somewhere disposable.
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(), "import.db"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+_BEFORE_INTEGER_MONEY = [name for name, _ in main._DB_MIGRATIONS].index("0006_integer_money")
+
+
+@pytest.fixture
+def legacy_conn(monkeypatch):
+    """A database at the schema the REAL-money code wrote to, before 0006_integer_money."""
+    conn = sqlite3.connect(os.path.join(tempfile.mkdtemp(), "legacy.db"), isolation_level=None)
+    monkeypatch.setattr(main, "_DB_MIGRATIONS", main._DB_MIGRATIONS[:_BEFORE_INTEGER_MONEY])
+    main._db_migrate(conn)
+    monkeypatch.undo()
+    yield conn
+    conn.close()
+
+
+def _seed(conn, receipt_id, currency, total, lines):
+    # As the REAL-money writer stored them: provider minor units / 100, for every currency.
+    conn.execute(
+        "INSERT INTO receipts (id, user_id, merchant, payment_id, order_id, currency, total, ts, line_count) "
+        "VALUES (?, 'u', 'square', ?, NULL, ?, ?, 1700000000, ?)",
+        (receipt_id, receipt_id, currency, total, len(lines)),
+    )
+    for line_no, (quantity, unit_price) in enumerate(lines):
+        conn.execute(
+            "INSERT INTO receipt_lines (receipt_id, line_no, sku, item_name, quantity, unit_price) VALUES (?, ?, 's', 'n', ?, ?)",
+            (receipt_id, line_no, quantity, unit_price),
+        )
+
+
+def test_integer_money_keeps_legacy_amounts_in_provider_minor_units(legacy_conn):
+    _seed(legacy_conn, "usd", "USD", 0.3, [(1.5, 0.2)])
+    _seed(legacy_conn, "jpy", "JPY", 15.0, [(2, 7.5)])  # ¥1500, two lines of ¥750
+    _seed(legacy_conn, "kwd", "KWD", 12.34, [(1, 12.34)])  # 1.234 KWD
+    main._db_migrate(legacy_conn)
+
+    totals = dict(legacy_conn.execute("SELECT id, total_minor FROM receipts"))
+    assert totals == {"usd": 30, "jpy": 1500, "kwd": 1234}
+    lines = {
+        receipt_id: (quantity_scaled, unit_price_minor)
+        for receipt_id, quantity_scaled, unit_price_minor in legacy_conn.execute(
+            "SELECT receipt_id, quantity_scaled, unit_price_minor FROM receipt_lines"
+        )
+    }
+    assert lines == {"usd": (150000, 20), "jpy": (200000, 750), "kwd": (100000, 1234)}
+
+    assert main._minor_to_float(totals["jpy"], "JPY") == 1500.0
+    assert main._minor_to_float(totals["kwd"], "KWD") == 1.234
+
+    # The rollup backfill (0009) carries the converted amounts forward.
+    rollups = dict(legacy_conn.execute("SELECT currency, total_minor FROM rollup_daily_merchant"))
+    assert rollups == {"USD": 30, "JPY": 1500, "KWD": 1234}
@@ -0,0 +1,170 @@
+import os
+import sqlite3
+import sys
+import tempfile
+
+import pytest
+
+# main opens DB_PATH at import; point it somewhere disposable.
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(), "import.db"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+def _tx(n, lines=2, total_minor=500):
+    return {
+        "id": f"t{n}",
+        "user_id": "u",
+        "merchant": "square",
+        "payment_id": f"p{n}",
+        "timestamp": 1_700_000_000 + n,
+        "currency": "USD",
+        "total_minor": total_minor,
+        "items": [{"sku": f"s{i}", "name": "n", "quantity": 1, "unit_price_minor": 250} for i in range(lines)],
+        "meta": {"square_order_id": f"o{n}"},
+    }
+
+
+def _write(tx):
+    return main._db_write_tx(tx).result()
+
+
+def _queue_round_trip():
+    main._webhook_enqueue("square", "evt-queue", "{}")
+    job_id = main._webhook_claim("square")[0]
+    main._webhook_ack(job_id)
+
+
+def _queue_retry():
+    main._webhook_enqueue("square", "evt-retry", "{}")
+    job_id, _, _, attempts = main._webhook_claim("square")
+    main._webhook_fail(job_id, attempts, "boom")
+
+
+def _dedup_probe():
+    main._dedup_record("stripe", "evt-dedup")
+    main._dedup_seen("stripe", "evt-dedup")
+
+
+def _catalog_refresh():
+    main._catalog_db_stale_ids("m", 2**31)
+    main._catalog_db_refreshed("m", [], [{"id": "c1"}], 2**31)
+
+
+# Each hot path, driven through the main.py functions that issue it, and the index seeks
+# its plans must include. The statements are captured as SQLite runs them, so the plans
+# checked are always those of the current SQL.
+HOT_PATHS = {
+    "write: new receipt": (
+        lambda: _write(_tx(100)),
+        ["(user_id=? AND merchant=? AND payment_id=?)", "receipt_lines USING PRIMARY KEY (receipt_id=?)"],
+    ),
+    "write: changed receipt": (
+        lambda: _write(_tx(1, lines=1, total_minor=700)),
+        ["(user_id=? AND merchant=? AND payment_id=?)", "receipts USING INDEX sqlite_autoindex_receipts_1 (id=?)",
+         "receipt_lines USING PRIMARY KEY (receipt_id=? AND line_no>?)",
+         "rollup_daily_sku USING PRIMARY KEY (user_id=? AND day=? AND sku=? AND currency=?)"],
+    ),
+    "write: unchanged receipt": (lambda: _write(_tx(2)), ["(user_id=? AND merchant=? AND payment_id=?)"]),
+    "listing: keyset page": (
+        lambda: main.TransactionStore(10).page("u", 5, after=(0, ""), since=0, until=2**31),
+        ["receipts_user_ts (user_id=? AND (ts,id)>(?,?)", "SEARCH p USING PRIMARY KEY (receipt_id=?)",
+         "receipt_lines USING PRIMARY KEY (receipt_id=?)"],
+    ),
+    "listing: newest first": (
+        lambda: main.TransactionStore(10).page("u", 5, newest_first=True, with_meta=False),
+        ["receipts_user_ts (user_id=?)"],
+    ),
+    "listing: change feed": (
+        lambda: main.TransactionStore(10).changes("u", 5, since=0, after="t3"),
+        ["receipt_changes_user_seq (user_id=? AND (seq,receipt_id)>(?,?))"],
+    ),
+    "listing: by payment": (
+        lambda: main.TransactionStore(10).by_payment("u", "square", "p3"),
+        ["(user_id=? AND merchant=? AND payment_id=?)"],
+    ),
+    "order: by order id": (
+        lambda: main.TransactionStore(10).by_order("u", "square", "o3"),
+        ["receipts_order (user_id=? AND merchant=? AND order_id=?)"],
+    ),
+    "demo: receipts pages": (
+        lambda: "".join(main._demo_receipts_html("u", 5)),
+        ["receipts_user_ts (user_id=?)", "receipts_user_ts (user_id=? AND (ts,id)<(?,?))",
+         "receipt_lines USING PRIMARY KEY (receipt_id=?)"],
+    ),
+    "versions: user version": (
+        lambda: main._UserVersions(0, 10).get("u"),
+        ["user_versions USING PRIMARY KEY (user_id=?)"],
+    ),
+    "queue: enqueue, claim, ack": (
+        _queue_round_trip,
+        ["webhook_jobs_visible (source=? AND visible_at<?)", "webhook_jobs USING INTEGER PRIMARY KEY (rowid=?)"],
+    ),
+    "queue: claim, fail": (
+        _queue_retry,
+        ["webhook_jobs_visible (source=? AND visible_at<?)", "webhook_jobs USING INTEGER PRIMARY KEY (rowid=?)"],
+    ),
+    "dedup: probe": (_dedup_probe, ["processed_events USING PRIMARY KEY (source=? AND event_id=?)"]),
+    "dedup: prune": (main._dedup_prune, ["processed_events_received (received_at<?)"]),
+    "catalog: load": (
+        lambda: main._catalog_db_load("m", ["c2", "c3"]),
+        ["catalog_objects USING INDEX sqlite_autoindex_catalog_objects_1 (merchant_id=? AND object_id=?)"],
+    ),
+    "catalog: stale refresh": (
+        _catalog_refresh,
+        ["catalog_objects_fetched (merchant_id=? AND fetched_at<?)", "(merchant_id=? AND object_id=?)"],
+    ),
+}
+
+_STATEMENTS = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+
+@pytest.fixture(scope="module")
+def traced():
+    statements = []
+    connect = main._DbPool._connect
+
+    def traced_connect(self):
+        conn = connect(self)
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(main._DbPool, "_connect", traced_connect)
+        # Several chunks per demo page, so the keyset bound is exercised too.
+        mp.setattr(main, "DEMO_RECEIPTS_CHUNK_ROWS", 2)
+        main._shards.close()
+        main._db.close()
+        for n in range(10):
+            _write(_tx(n))
+        main._catalog_db_save("m", [{"id": f"c{n}", "item_variation_data": {"sku": "s", "name": "n"}} for n in range(5)])
+        yield statements
+    main._shards.close()
+    main._db.close()
+
+
+def _plan(conn, sql):
+    return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql)]
+
+
+@pytest.mark.parametrize("name", sorted(HOT_PATHS))
+def test_hot_path_uses_indexes(traced, name):
+    run, seeks = HOT_PATHS[name]
+    del traced[:]
+    run()
+    issued = [sql for sql in traced if sql.lstrip().split(None, 1)[0].upper() in _STATEMENTS]
+    assert issued, "no statements captured"
+
+    conn = sqlite3.connect(main._db.path)
+    try:
+        plans = {sql: _plan(conn, sql) for sql in issued}
+    finally:
+        conn.close()
+    searches = [step for plan in plans.values() for step in plan if step.startswith("SEARCH")]
+    for seek in seeks:
+        assert any(seek in step for step in searches), (seek, plans)
+    # Plain INSERT ... VALUES has no plan; everything that looks rows up must seek.
+    for sql, plan in plans.items():
+        assert not any(step.startswith("SCAN") for step in plan), (sql, plan)
+        assert not any("TEMP B-TREE" in step for step in plan), (sql, plan)